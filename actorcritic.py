@@ -6,14 +6,18 @@ from torch.nn.utils import clip_grad_norm_
 from torch.distributions import Categorical, Normal
 import numpy as np
 import os
+import copy
+import json
+import random
+import threading
 from collections import namedtuple
-from time import time
-from torch.utils.tensorboard import SummaryWriter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import time, perf_counter
 
 ######################################################################
 # 1. Define the Policy (Actor) and Value (Critic) Networks
 class Network(nn.Module):
-    def __init__(self, input_size, output_size, hidden_sizes=[64, 64], is_policy=True):
+    def __init__(self, input_size, output_size, hidden_sizes=[64, 64], is_policy=True, fused=False):
         super(Network, self).__init__()
         self.hidden_sizes = hidden_sizes
         layers = [nn.Linear(input_size, hidden_sizes[0]), nn.ReLU()]
@@ -24,13 +28,89 @@ class Network(nn.Module):
         
         self.network = nn.Sequential(*layers)
         self.is_policy = is_policy
+        # fused execution: packed weights and a direct addmm/relu chain instead of the Sequential, see pack
+        self.fused = fused
+        if fused:
+            self.pack()
+
+    def pack(self):
+        """
+        Moves the weights and biases of all Linear layers into one contiguous buffer, flat_parameters,
+        trainable ones first. The parameters stay separate leaves viewing into it, so state_dict keys
+        (the .pth files in models/) and per-layer requires_grad (reinitialize_output_layer) are unchanged.
+        trainable_parameters is a leaf over the trainable part, which PackedAdam steps as one tensor.
+        """
+        linears = [layer for layer in self.network if isinstance(layer, nn.Linear)]
+        params = [param for layer in linears for param in (layer.weight, layer.bias)]
+        self.trainable = [param for param in params if param.requires_grad]
+        params = self.trainable + [param for param in params if not param.requires_grad]
+        flat_parameters = torch.cat([param.detach().reshape(-1) for param in params])
+        offset = 0
+        for param in params:
+            param.data = flat_parameters[offset:offset + param.numel()].view_as(param)
+            offset += param.numel()
+        self.flat_parameters = flat_parameters
+        num_trainable = sum(param.numel() for param in self.trainable)
+        self.trainable_parameters = flat_parameters[:num_trainable].detach().requires_grad_(num_trainable > 0)
+        self.layers = [(layer.weight, layer.bias) for layer in linears]
+        # reinitialize_output_layer appends a Softmax to the Sequential itself
+        self.output_softmax = isinstance(self.network[-1], nn.Softmax)
+
+    def is_packed(self):
+        start = self.flat_parameters.data_ptr()
+        end = start + self.flat_parameters.numel() * self.flat_parameters.element_size()
+        return all(start <= param.data_ptr() < end for param in self.parameters())
+
+    def gather_grads(self):
+        """
+        Moves the gradients of the trainable parameters into trainable_parameters.grad.
+        """
+        grads = [param.grad if param.grad is not None else torch.zeros_like(param) for param in self.trainable]
+        self.trainable_parameters.grad = torch.cat([grad.reshape(-1) for grad in grads])
+        for param in self.trainable:
+            param.grad = None
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to(device) and friends may replace the parameter storage, then pack again
+        super(Network, self)._apply(fn, *args, **kwargs)
+        if self.fused and not self.is_packed():
+            self.pack()
+        return self
+
+    def fused_logits(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        for weight, bias in self.layers[:-1]:
+            x = torch.relu(torch.addmm(bias, x, weight.t()))
+        weight, bias = self.layers[-1]
+        x = torch.addmm(bias, x, weight.t())
+        if self.output_softmax:
+            x = torch.softmax(x, dim=-1)
+        return x.reshape(*shape[:-1], x.shape[-1])
 
     def forward(self, x):
+        if self.fused:
+            x = self.fused_logits(x)
+            return torch.softmax(x, dim=-1) if self.is_policy else x
         if self.is_policy:
             return nn.Softmax(dim=-1)(self.network(x))
         else:
             return self.network(x)
 
+    def logits(self, x):
+        """
+        The input of the final softmax of a policy network, i.e. forward(x) == softmax(logits(x)).
+        """
+        if self.fused:
+            return self.fused_logits(x)
+        return self.network(x)
+
+    def log_probs(self, x):
+        """
+        log(forward(x)) of a policy network, computed directly with log_softmax.
+        """
+        return torch.log_softmax(self.logits(x), dim=-1)
+
     def reinitialize_output_layer(self, output_size, freeze_hidden_layers=True):
         if freeze_hidden_layers:
             for param in self.network[:-1].parameters():
@@ -41,69 +121,1760 @@ class Network(nn.Module):
         nn.init.constant_(self.network[-1].bias, 0)
         if self.is_policy:
             self.network.add_module("softmax", nn.Softmax(dim=-1))
+        if self.fused:
+            self.pack()
+
+
+class GaussianPolicyNetwork(nn.Module):
+    """
+    Continuous-action policy: forward(x) returns (mean, log_std) of a diagonal Gaussian. log_std is a
+    learned per-dimension parameter (state-independent), or with state_dependent_std a second half of
+    the output layer; it is clamped to log_std_bounds. Samples are not squashed, the env wrappers clip them.
+    """
+    def __init__(self, input_size, action_size, hidden_sizes=[64, 64], state_dependent_std=False, log_std_init=0.0,
+                 log_std_bounds=(-5.0, 2.0)):
+        super(GaussianPolicyNetwork, self).__init__()
+        self.hidden_sizes = hidden_sizes
+        self.action_size = action_size
+        self.state_dependent_std = state_dependent_std
+        self.log_std_bounds = log_std_bounds
+        layers = [nn.Linear(input_size, hidden_sizes[0]), nn.ReLU()]
+        for i in range(len(hidden_sizes)-1):
+            layers.append(nn.Linear(hidden_sizes[i], hidden_sizes[i+1]))
+            layers.append(nn.ReLU())
+        layers.append(nn.Linear(hidden_sizes[-1], action_size * (2 if state_dependent_std else 1)))
+        self.network = nn.Sequential(*layers)
+        self.reset_log_std(log_std_init)
+
+    def reset_log_std(self, log_std_init):
+        if self.state_dependent_std:
+            nn.init.constant_(self.network[-1].bias[self.action_size:], log_std_init)
+        else:
+            self.log_std = nn.Parameter(torch.full((self.action_size,), float(log_std_init)))
+
+    def forward(self, x):
+        output = self.network(x)
+        if self.state_dependent_std:
+            mean, log_std = output[..., :self.action_size], output[..., self.action_size:]
+        else:
+            mean, log_std = output, self.log_std.expand_as(output)
+        return mean, log_std.clamp(*self.log_std_bounds)
+
+    def distribution(self, x):
+        mean, log_std = self(x)
+        return Normal(mean, log_std.exp())
+
+    def act(self, states, deterministic=False, generator=None):
+        """
+        Numpy actions for a batch of numpy states: the mean when deterministic, else a sample
+        (drawn from generator if given, else from the global torch RNG).
+        """
+        with torch.no_grad():
+            states = torch.as_tensor(np.asarray(states), dtype=torch.float32, device=self.network[0].weight.device)
+            mean, log_std = self(states)
+            actions = mean if deterministic else torch.normal(mean, log_std.exp(), generator=generator)
+        return actions.cpu().numpy()
+
+    def reinitialize_output_layer(self, output_size, freeze_hidden_layers=True, log_std_init=0.0):
+        if freeze_hidden_layers:
+            for param in self.network[:-1].parameters():
+                param.requires_grad = False
+
+        self.action_size = output_size
+        self.network[-1] = nn.Linear(self.hidden_sizes[-1], output_size * (2 if self.state_dependent_std else 1))
+        nn.init.normal_(self.network[-1].weight, mean=0., std=0.1)
+        nn.init.constant_(self.network[-1].bias, 0)
+        self.reset_log_std(log_std_init)
+
+
+class PackedAdam(optim.Adam):
+    """
+    Adam over a fused Network as one tensor (its trainable_parameters) instead of one per layer
+    weight and bias. Gradients are gathered from the parameters at every step. Build a new one
+    after the network is packed again, e.g. after reinitialize_output_layer.
+    """
+    def __init__(self, network, lr):
+        self.network = network
+        super(PackedAdam, self).__init__([network.trainable_parameters], lr=lr)
+
+    def step(self, closure=None):
+        self.network.gather_grads()
+        return super(PackedAdam, self).step(closure)
+
+    def zero_grad(self, set_to_none=True):
+        super(PackedAdam, self).zero_grad(set_to_none)
+        for param in self.network.trainable:
+            param.grad = None
+
+
+class PolicyInference:
+    """
+    Low-overhead action sampling for a policy network, used by select_action.
+    Samples straight from the logits with the Gumbel-max trick instead of building a Categorical,
+    and writes states into a reusable input buffer.
+    backend='torch' runs the live network under torch.inference_mode, optionally traced with
+    TorchScript (compile='script') or torch.compile (compile='compile').
+    backend='numpy' runs a float32 NumPy copy of the weights, which suits CPU rollout workers;
+    call refresh() after every optimizer step to pick up new weights (and, for a compiled torch
+    backend, layers replaced e.g. by reinitialize_output_layer).
+    Samples come from rng, by default a generator seeded from the global NumPy state, so np.random.seed
+    fixes it too.
+    """
+    def __init__(self, network, backend='torch', compile=None, device=torch.device('cpu'), rng=None):
+        self.network = network
+        self.backend = backend
+        self.compile = compile
+        self.device = torch.device(device)
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31 - 1)) if rng is None else rng
+        self.input = None
+        if backend == 'numpy':
+            if not self.supports_numpy(network):
+                raise ValueError("the numpy backend needs a Network made of Linear/ReLU/Softmax layers")
+            self.refresh()
+        elif backend == 'torch':
+            self.build_logits_fn()
+        else:
+            raise ValueError(f"unknown inference backend {backend}")
+
+    def build_logits_fn(self):
+        network = self.network
+        logits = network.logits if hasattr(network, 'logits') else (lambda x: torch.log(network(x)))
+        if self.compile == 'script':
+            example = torch.zeros(1, network.network[0].in_features, device=self.device)
+            logits = torch.jit.trace(network.network, example) if isinstance(network, Network) else logits
+        elif self.compile == 'compile':
+            logits = torch.compile(logits)
+        self.logits_fn = logits
+        # the traced/compiled graph holds on to these modules; it shares their parameters, not replacements
+        self.compiled_modules = tuple(network.modules())
+
+    @staticmethod
+    def supports_numpy(network):
+        return isinstance(network, Network) and all(isinstance(layer, (nn.Linear, nn.ReLU, nn.Softmax)) for layer in network.network)
+
+    def refresh(self):
+        """
+        Copies the current weights of the network into the numpy backend. The torch backend runs the
+        live weights, but a compiled one is rebuilt when layers of the network were replaced.
+        """
+        if self.backend != 'numpy':
+            if self.compile is not None and tuple(self.network.modules()) != self.compiled_modules:
+                self.build_logits_fn()
+            return
+        self.layers = []
+        for layer in self.network.network:
+            if isinstance(layer, nn.Linear):
+                self.layers.append(('linear', layer.weight.detach().cpu().numpy().T.copy(), layer.bias.detach().cpu().numpy().copy()))
+            else:
+                self.layers.append(('relu' if isinstance(layer, nn.ReLU) else 'softmax', None, None))
+
+    def set_input(self, states):
+        states = np.asarray(states)
+        shape = states.shape if states.ndim == 2 else (1, states.shape[0])
+        if self.input is None or self.input.shape != shape:
+            if self.backend == 'numpy':
+                self.input = np.empty(shape, dtype=np.float32)
+            else:
+                self.input = torch.empty(shape, dtype=torch.float32, device=self.device)
+                self.input_np = self.input.numpy() if self.device.type == 'cpu' else None
+        if self.backend == 'numpy':
+            np.copyto(self.input, states.reshape(shape), casting='unsafe')
+        elif self.input_np is not None:
+            np.copyto(self.input_np, states.reshape(shape), casting='unsafe')
+        else:
+            self.input.copy_(torch.as_tensor(states.reshape(shape), dtype=torch.float32))
+
+    def logits(self, states):
+        """
+        Logits of states as a [batch, actions] numpy array.
+        """
+        self.set_input(states)
+        if self.backend == 'numpy':
+            x = self.input
+            for kind, weight, bias in self.layers:
+                if kind == 'linear':
+                    x = x @ weight + bias
+                elif kind == 'relu':
+                    np.maximum(x, 0, out=x)
+                else:
+                    x = x - x.max(axis=-1, keepdims=True)
+                    np.exp(x, out=x)
+                    x /= x.sum(axis=-1, keepdims=True)
+            return x
+        with torch.inference_mode():
+            return self.logits_fn(self.input).cpu().numpy()
+
+    def sample(self, states, action_masks=None):
+        """
+        Returns (actions, log_probs) as numpy arrays with one entry per row of states.
+        Actions where action_masks (broadcast to the logits) is False are never sampled.
+        """
+        logits = self.logits(states)
+        if action_masks is not None:
+            logits = np.where(action_masks, logits, -np.inf)
+        actions = np.argmax(logits + self.rng.gumbel(size=logits.shape), axis=-1)
+        shifted = logits - logits.max(axis=-1, keepdims=True)
+        log_norm = np.log(np.exp(shifted).sum(axis=-1))
+        log_probs = np.take_along_axis(shifted, actions[:, None], axis=-1)[:, 0] - log_norm
+        return actions, log_probs
+
+
+######################################################################
+# Transfer: frozen source columns and progressive networks
+def load_network(model_path, input_size=6, output_size=3, hidden_sizes=[64, 64], is_policy=True, device=torch.device('cpu')):
+    network = Network(input_size, output_size, hidden_sizes, is_policy)
+    network.load_state_dict(torch.load(model_path, map_location=device))
+    return network.to(device)
+
+
+def freeze_network(network):
+    for param in network.parameters():
+        param.requires_grad = False
+
+
+class FrozenColumns(nn.Module):
+    """
+    The hidden stacks of frozen source networks, evaluated together.
+    Columns with the same layer sizes are packed into stacked weight buffers and run as one chain of
+    batched matmuls, so adding a column barely costs more than one. forward returns the top hidden
+    features of every column concatenated, [..., num_columns * hidden_size]; the output of the latest
+    call is kept in last_features so the agent can cache it in the rollout.
+    """
+    def __init__(self, source_networks):
+        super(FrozenColumns, self).__init__()
+        hidden_stacks = []
+        for source in source_networks:
+            linears = [layer for layer in source.network if isinstance(layer, nn.Linear)][:-1]
+            hidden_stacks.append(linears)
+        self.num_columns = len(hidden_stacks)
+        self.num_layers = len(hidden_stacks[0])
+        if any([(l.in_features, l.out_features) for l in stack] != [(l.in_features, l.out_features) for l in hidden_stacks[0]]
+               for stack in hidden_stacks):
+            raise ValueError("all frozen columns must have the same layer sizes")
+        self.hidden_size = hidden_stacks[0][-1].out_features
+        for i in range(self.num_layers):
+            weight = torch.stack([stack[i].weight.detach().t() for stack in hidden_stacks])
+            bias = torch.stack([stack[i].bias.detach() for stack in hidden_stacks]).unsqueeze(1)
+            self.register_buffer(f'weight_{i}', weight.clone())
+            self.register_buffer(f'bias_{i}', bias.clone())
+        self.last_features = None
+
+    @property
+    def feature_size(self):
+        return self.num_columns * self.hidden_size
+
+    def forward(self, x):
+        with torch.no_grad():
+            h = x.reshape(1, -1, x.shape[-1]).expand(self.num_columns, -1, -1)
+            for i in range(self.num_layers):
+                h = torch.relu(torch.baddbmm(getattr(self, f'bias_{i}'), h, getattr(self, f'weight_{i}')))
+            features = h.permute(1, 0, 2).reshape(*x.shape[:-1], self.feature_size)
+        self.last_features = features
+        return features
+
+
+class ProgressiveNetwork(nn.Module):
+    """
+    Target column of a progressive network: its input is the state concatenated with the top hidden
+    features of frozen source columns. columns can be shared with another ProgressiveNetwork (see
+    make_progressive_networks); column_indices selects the columns this network reads.
+    """
+    def __init__(self, input_size, output_size, hidden_sizes, source_networks=[], is_policy=True, columns=None, column_indices=None):
+        super(ProgressiveNetwork, self).__init__()
+        self.is_policy = is_policy
+        self.hidden_sizes = hidden_sizes
+        if columns is None and source_networks:
+            columns = FrozenColumns(source_networks)
+        self.columns = columns
+        if columns is not None and column_indices is None:
+            column_indices = list(range(columns.num_columns))
+        self.column_indices = column_indices or []
+        # Adjust the input size to include source networks' top hidden layer outputs
+        adjusted_input_size = input_size + (columns.hidden_size * len(self.column_indices) if columns is not None else 0)
+
+        # Building the layers
+        layers = [nn.Linear(adjusted_input_size, hidden_sizes[0]), nn.ReLU()]
+        for i in range(1, len(hidden_sizes)):
+            layers.append(nn.Linear(hidden_sizes[i-1], hidden_sizes[i]))
+            layers.append(nn.ReLU())
+        layers.append(nn.Linear(hidden_sizes[-1], output_size))
+        self.network = nn.Sequential(*layers)
+
+    def select_features(self, features):
+        if self.column_indices == list(range(self.columns.num_columns)):
+            return features
+        size = self.columns.hidden_size
+        return torch.cat([features[..., i * size:(i + 1) * size] for i in self.column_indices], dim=-1)
+
+    def logits(self, x, features=None):
+        if self.columns is not None:
+            if features is None:
+                features = self.columns(x)
+            x = torch.cat([x, self.select_features(features)], dim=-1)
+        return self.network(x)
+
+    def forward(self, x, features=None):
+        if self.is_policy:
+            return torch.softmax(self.logits(x, features), dim=-1)
+        return self.logits(x, features)
+
+
+def make_progressive_networks(policy_sources, value_sources, input_size, output_size, hidden_sizes, device=torch.device('cpu')):
+    """
+    Builds a progressive policy and value network over one shared FrozenColumns holding the
+    policy sources followed by the value sources.
+    """
+    for source in policy_sources + value_sources:
+        freeze_network(source)
+    columns = FrozenColumns(policy_sources + value_sources)
+    num_policy = len(policy_sources)
+    policy_network = ProgressiveNetwork(input_size, output_size, hidden_sizes, is_policy=True, columns=columns,
+                                        column_indices=list(range(num_policy)))
+    value_network = ProgressiveNetwork(input_size, 1, hidden_sizes, is_policy=False, columns=columns,
+                                       column_indices=list(range(num_policy, columns.num_columns)))
+    return policy_network.to(device), value_network.to(device)
+
+
+class MultiHeadNetwork(nn.Module):
+    """
+    One shared hidden trunk with an output head per task, for multi-task training. Inputs are laid out
+    [..., num_tasks, input_size] with row t belonging to task t, so the heads of all tasks are applied
+    in one einsum over the shared features. task_network(t) exports task t as a plain Network,
+    e.g. to save it as a source column for the transfer notebooks.
+    """
+    def __init__(self, input_size, output_size, num_tasks, hidden_sizes=[64, 64], is_policy=True):
+        super(MultiHeadNetwork, self).__init__()
+        self.input_size, self.output_size = input_size, output_size
+        self.hidden_sizes = hidden_sizes
+        self.is_policy = is_policy
+        layers = [nn.Linear(input_size, hidden_sizes[0]), nn.ReLU()]
+        for i in range(len(hidden_sizes)-1):
+            layers.append(nn.Linear(hidden_sizes[i], hidden_sizes[i+1]))
+            layers.append(nn.ReLU())
+        self.trunk = nn.Sequential(*layers)
+        heads = [nn.Linear(hidden_sizes[-1], output_size) for _ in range(num_tasks)]
+        self.head_weight = nn.Parameter(torch.stack([head.weight.detach() for head in heads]))
+        self.head_bias = nn.Parameter(torch.stack([head.bias.detach() for head in heads]))
+
+    @property
+    def num_tasks(self):
+        return self.head_weight.shape[0]
+
+    def logits(self, x):
+        return torch.einsum('...th,toh->...to', self.trunk(x), self.head_weight) + self.head_bias
+
+    def forward(self, x):
+        if self.is_policy:
+            return torch.softmax(self.logits(x), dim=-1)
+        return self.logits(x)
+
+    def log_probs(self, x):
+        return torch.log_softmax(self.logits(x), dim=-1)
+
+    def task_network(self, task):
+        network = Network(self.input_size, self.output_size, self.hidden_sizes, self.is_policy)
+        linears = [layer for layer in network.network if isinstance(layer, nn.Linear)]
+        with torch.no_grad():
+            for target, source in zip(linears, [layer for layer in self.trunk if isinstance(layer, nn.Linear)]):
+                target.weight.copy_(source.weight)
+                target.bias.copy_(source.bias)
+            linears[-1].weight.copy_(self.head_weight[task])
+            linears[-1].bias.copy_(self.head_bias[task])
+        return network.to(self.head_weight.device)
 
 
 ######################################################################
 #2. Reshape the environment wrapper to handle the action space
+def padded_action_mask(action_space, target_action_size):
+    """
+    Boolean mask of the real actions among target_action_size padded slots, or None when all of them are real.
+    """
+    if action_space >= target_action_size:
+        return None
+    mask = np.zeros(target_action_size, dtype=bool)
+    mask[:action_space] = True
+    return mask
+
+
+def fit_action_mask(mask, num_actions):
+    """
+    Action mask (or batch of them) cut or padded with False to a policy with num_actions outputs,
+    e.g. after reinitialize_output_layers to a narrower head, or None when all of them are real.
+    """
+    if mask is None:
+        return None
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape[-1] >= num_actions:
+        mask = mask[..., :num_actions]
+    else:
+        mask = np.concatenate([mask, np.zeros(mask.shape[:-1] + (num_actions - mask.shape[-1],), dtype=bool)], axis=-1)
+    return None if mask.all() else mask
+
+
 class EnvironmentWrapper:
+    """
+    Pads states to target_state_size and exposes the real actions among target_action_size as action_mask.
+    States are float32 views into two preallocated buffers that are written alternately,
+    so a returned state stays valid until the second call after it.
+    Subclasses list the attributes a resumed run must get back (e.g. episode counters) in state_attributes,
+    see get_state; the configuration of the wrapper is never part of a checkpoint.
+    """
+    state_attributes = ()
+
     def __init__(self, env, target_state_size=6, target_action_size=3):
         self.env = env
         self.target_state_size = target_state_size
         self.target_action_size = target_action_size
         self.action_space = env.action_space.n if isinstance(env.action_space, gym.spaces.Discrete) else env.action_space.shape[0]
+        if isinstance(env.action_space, gym.spaces.Box):
+            self.action_low, self.action_high = env.action_space.low, env.action_space.high
+        # whether the last step was cut short by a time limit; step keeps returning (state, reward, done, info)
+        self.truncated = False
+        self.observations = np.zeros((2, target_state_size), dtype=np.float32)
+        self.current = 0
+
+    @property
+    def action_mask(self):
+        # subclasses may change action_space after __init__, e.g. to discretize a Box
+        return padded_action_mask(self.action_space, self.target_action_size)
+
+    def get_state(self):
+        """
+        The state_attributes of the wrapper, saved in checkpoints next to the RNG state of its env.
+        """
+        return {name: getattr(self, name) for name in self.state_attributes}
+
+    def set_state(self, state):
+        for name in self.state_attributes:
+            if name in state:
+                setattr(self, name, state[name])
+
+    def pad(self, state):
+        self.current ^= 1
+        observation = self.observations[self.current]
+        observation[:len(state)] = state
+        return observation
 
     def reset(self):
         state, _ = self.env.reset()
-        # Pad state to match target_state_size
-        padded_state = np.append(state, np.zeros(self.target_state_size - len(state)))
-        return padded_state
+        self.truncated = False
+        return self.pad(state)
 
     def step(self, action):
-        action = min(self.action_space-1, max(0, action))
+        if hasattr(self, 'action_low'):
+            action = np.clip(action, self.action_low, self.action_high)
+        else:
+            action = min(self.action_space-1, max(0, action))
         
-        state, reward, done, _, info = self.env.step(action)
-        # Pad state to match target_state_size
-        padded_state = np.append(state, np.zeros(self.target_state_size - len(state)))
-        return padded_state, reward, done, info
+        state, reward, done, truncated, info = self.env.step(action)
+        self.truncated = truncated
+        return self.pad(state), reward, done, info
 
     def action_padding(self, action):
         one_hot_action = np.zeros(self.target_action_size)
         one_hot_action[action] = 1
         return one_hot_action
 
+class VectorEnvironmentWrapper:
+    """
+    Batched counterpart of EnvironmentWrapper for a gymnasium SyncVectorEnv/AsyncVectorEnv.
+    Pads the whole batch of states into preallocated float32 buffers (the states to act on
+    alternate between two, as in EnvironmentWrapper) and clamps the whole batch of actions at once.
+    """
+    def __init__(self, envs, target_state_size=6, target_action_size=3):
+        autoreset_mode = envs.metadata.get('autoreset_mode')
+        if autoreset_mode is not None and getattr(autoreset_mode, 'value', autoreset_mode) != 'SameStep':
+            raise ValueError("VectorEnvironmentWrapper needs a vector env that autoresets in the same step, see make_vector_env")
+        self.envs = envs
+        self.num_envs = envs.num_envs
+        self.target_state_size = target_state_size
+        self.target_action_size = target_action_size
+        space = envs.single_action_space
+        self.action_space = space.n if isinstance(space, gym.spaces.Discrete) else space.shape[0]
+        if isinstance(space, gym.spaces.Box):
+            self.action_low, self.action_high = space.low, space.high
+        else:
+            self.action_low, self.action_high = 0, self.action_space - 1
+        mask = padded_action_mask(self.action_space, target_action_size)
+        self.action_mask = None if mask is None else np.tile(mask, (self.num_envs, 1))
+        self.observations = np.zeros((2, self.num_envs, target_state_size), dtype=np.float32)
+        self.next_observations = np.zeros((self.num_envs, target_state_size), dtype=np.float32)
+        self.current = 0
+
+    def pad(self, states, out=None):
+        if out is None:
+            self.current ^= 1
+            out = self.observations[self.current]
+        out[:, :states.shape[1]] = states
+        return out
+
+    def reset(self, seed=None):
+        states, info = self.envs.reset(seed=seed)
+        if 'action_mask' in info:
+            # PaddedEnv copies (see make_vector_env) have a padded action space and report their real actions
+            mask = np.stack(list(info['action_mask'])).astype(bool)
+            self.action_mask = None if mask.all() else mask
+        return self.pad(states)
+
+    def step(self, actions):
+        """
+        Returns the states to act on next, the rewards, the terminated and truncated flags
+        and the true next states of this step (final observations for the envs that just
+        finished an episode and were reset).
+        """
+        actions = np.clip(actions, self.action_low, self.action_high)
+
+        states, rewards, dones, truncated, info = self.envs.step(actions)
+        next_states = self.pad(states, self.next_observations)
+        # gymnasium>=1.0 uses 'final_obs', 0.29 uses 'final_observation'
+        for key in ('final_obs', 'final_observation'):
+            if key in info:
+                for i in np.flatnonzero(info[f'_{key}']):
+                    next_states[i, :len(info[key][i])] = info[key][i]
+        return self.pad(states), rewards, dones, truncated, next_states
+
+    def close(self):
+        self.envs.close()
+
+
+class PaddedEnv(gym.Wrapper):
+    """
+    Gymnasium-API counterpart of EnvironmentWrapper: float32 observations padded to target_state_size,
+    and for discrete envs a Discrete(target_action_size) action space whose real actions are given by
+    action_mask, also returned as info['action_mask'] (the gymnasium convention, so vector envs batch it;
+    VectorEnvironmentWrapper reads it on reset). Padded actions are clamped to the last real one.
+    Observations alternate between two preallocated buffers, as in EnvironmentWrapper.
+    """
+    def __init__(self, env, target_state_size=6, target_action_size=3):
+        super(PaddedEnv, self).__init__(env)
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, (target_state_size,), dtype=np.float32)
+        self.num_actions = env.action_space.n if isinstance(env.action_space, gym.spaces.Discrete) else None
+        self.action_mask = None
+        if self.num_actions is not None:
+            self.action_space = gym.spaces.Discrete(max(self.num_actions, target_action_size))
+            self.action_mask = padded_action_mask(self.num_actions, target_action_size)
+        self.observations = np.zeros((2, target_state_size), dtype=np.float32)
+        self.current = 0
+
+    def pad(self, state, info):
+        self.current ^= 1
+        observation = self.observations[self.current]
+        observation[:len(state)] = state
+        if self.action_mask is not None:
+            info['action_mask'] = self.action_mask
+        return observation, info
+
+    def reset(self, **kwargs):
+        state, info = self.env.reset(**kwargs)
+        return self.pad(state, info)
+
+    def step(self, action):
+        if self.num_actions is not None:
+            action = min(self.num_actions - 1, int(action))
+        state, reward, terminated, truncated, info = self.env.step(action)
+        observation, info = self.pad(state, info)
+        return observation, reward, terminated, truncated, info
+
+
+def make_vector_env(env_name, num_envs, max_steps=None, asynchronous=False, target_state_size=6, target_action_size=3):
+    """
+    Builds a vector env of num_envs PaddedEnv copies of env_name that autoresets finished copies in
+    the same step. asynchronous=True runs every copy in its own process.
+    """
+    env_fns = [lambda: PaddedEnv(gym.make(env_name, max_episode_steps=max_steps), target_state_size, target_action_size)
+               for _ in range(num_envs)]
+    vector_env_cls = gym.vector.AsyncVectorEnv if asynchronous else gym.vector.SyncVectorEnv
+    kwargs = {}
+    if hasattr(gym.vector, 'AutoresetMode'):
+        kwargs['autoreset_mode'] = gym.vector.AutoresetMode.SAME_STEP
+    return vector_env_cls(env_fns, **kwargs)
+
+######################################################################
+# Metrics: compact result columns and buffered, non-blocking logging
+class MetricColumn:
+    """
+    Growable float32 (or int32) column standing in for the per-episode lists in results.
+    Supports what train and its callbacks use on a list: append, len, indexing and slicing.
+    """
+    def __init__(self, dtype=np.float32, capacity=1024):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == len(self.data):
+            self.data = np.concatenate([self.data, np.zeros_like(self.data)])
+        self.data[self.size] = value
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.data[:self.size][index]
+
+    def __iter__(self):
+        return iter(self.data[:self.size])
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array() if dtype is None else self.array().astype(dtype)
+
+    def array(self):
+        return self.data[:self.size].copy()
+
+    @classmethod
+    def from_array(cls, values):
+        values = np.asarray(values)
+        column = cls(values.dtype, max(len(values), 1024))
+        column.data[:len(values)] = values
+        column.size = len(values)
+        return column
+
+
+class NullMetricsWriter:
+    """
+    Discards all scalars, e.g. for sweeps and benchmarks.
+    """
+    def add_scalar(self, tag, value, step):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TensorBoardSink:
+    """
+    Writes flushed scalars to TensorBoard event files; tensorboard is imported on first write.
+    """
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.writer = None
+
+    def write(self, steps, metric_ids, values, names):
+        if self.writer is None:
+            from torch.utils.tensorboard import SummaryWriter
+            self.writer = SummaryWriter(self.log_dir)
+        for step, metric_id, value in zip(steps.tolist(), metric_ids.tolist(), values.tolist()):
+            self.writer.add_scalar(names[metric_id], value, step)
+        self.writer.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+METRIC_RECORD = np.dtype([('step', '<i8'), ('metric', '<i4'), ('value', '<f4')])
+
+
+class ColumnarFileSink:
+    """
+    Appends flushed scalars as packed (step, metric id, float32 value) records to path, with the
+    metric names in path + '.json'. Read back with load_metrics.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.num_names = 0
+
+    def write(self, steps, metric_ids, values, names):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        records = np.empty(len(steps), dtype=METRIC_RECORD)
+        records['step'], records['metric'], records['value'] = steps, metric_ids, values
+        with open(self.path, 'ab') as f:
+            records.tofile(f)
+        if len(names) != self.num_names:
+            with open(self.path + '.json', 'w') as f:
+                json.dump(names, f)
+            self.num_names = len(names)
+
+    def close(self):
+        pass
+
+
+def load_metrics(path):
+    """
+    Reads a ColumnarFileSink file into {metric name: (steps, values)}.
+    """
+    with open(path + '.json') as f:
+        names = json.load(f)
+    records = np.fromfile(path, dtype=METRIC_RECORD)
+    return {name: (records['step'][records['metric'] == i], records['value'][records['metric'] == i])
+            for i, name in enumerate(names)}
+
+
+class BufferedMetricsWriter:
+    """
+    Drop-in for SummaryWriter.add_scalar that never blocks training on I/O. Scalars go into a
+    preallocated ring buffer of (step, metric id, float32 value) columns, which a background thread
+    flushes to a sink every flush_interval seconds (sooner when the buffer is half full). If the
+    flush thread falls a whole buffer behind, the oldest scalars are dropped and counted in dropped.
+    """
+    def __init__(self, sink, flush_interval=5.0, capacity=65536):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.steps = np.zeros(capacity, dtype=np.int64)
+        self.metric_ids = np.zeros(capacity, dtype=np.int32)
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.names = []
+        self.name_ids = {}
+        self.head = 0  # scalars written so far
+        self.tail = 0  # scalars handed to the sink so far
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.thread = None
+
+    def add_scalar(self, tag, value, step):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        with self.lock:
+            metric_id = self.name_ids.get(tag)
+            if metric_id is None:
+                metric_id = self.name_ids[tag] = len(self.names)
+                self.names.append(tag)
+            if self.head - self.tail >= self.capacity:
+                self.tail += 1
+                self.dropped += 1
+            i = self.head % self.capacity
+            self.steps[i], self.metric_ids[i], self.values[i] = step, metric_id, value
+            self.head += 1
+            pending = self.head - self.tail
+        if pending >= self.capacity // 2:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+            if self.closing:
+                break
+
+    def flush(self):
+        with self.lock:
+            indices = np.arange(self.tail, self.head) % self.capacity
+            steps, metric_ids, values = self.steps[indices], self.metric_ids[indices], self.values[indices]
+            names = list(self.names)
+            self.tail = self.head
+        if len(indices):
+            self.sink.write(steps, metric_ids, values, names)
+
+    def close(self):
+        """
+        Flushes everything that is pending and stops the thread; a later add_scalar restarts it.
+        """
+        if self.thread is not None:
+            self.closing = True
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+            self.closing = False
+            self.flush()
+        self.sink.close()
+
+
+def make_metrics_writer(config, log_dir):
+    """
+    config['metrics_backend']: 'tensorboard' (default), 'file' (ColumnarFileSink at
+    <log_dir>/metrics.bin) or 'none'; config['metrics_flush_interval'] in seconds.
+    """
+    backend = config.get('metrics_backend', 'tensorboard')
+    flush_interval = config.get('metrics_flush_interval', 5.0)
+    if backend == 'tensorboard':
+        return BufferedMetricsWriter(TensorBoardSink(log_dir), flush_interval)
+    if backend == 'file':
+        return BufferedMetricsWriter(ColumnarFileSink(os.path.join(log_dir, 'metrics.bin')), flush_interval)
+    if backend == 'none':
+        return NullMetricsWriter()
+    raise ValueError(f"unknown metrics backend {backend}")
+
+######################################################################
+# Checkpoints: full training state, written in the background
+def cpu_copy(obj):
+    """
+    Copy of a (nested dict/list/tuple of) tensors on the CPU, safe to serialize on another thread.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: cpu_copy(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(value) for value in obj)
+    return obj
+
+
+def list_checkpoints(directory, prefix=None):
+    """
+    Checkpoint files <prefix>_checkpoint_<episode>.pt in directory, oldest first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    checkpoints = []
+    for name in os.listdir(directory):
+        stem, marker, episode = name[:-len('.pt')].rpartition('_checkpoint_')
+        if not name.endswith('.pt') or not marker or not episode.isdigit():
+            continue
+        if prefix is None or stem == prefix:
+            checkpoints.append((int(episode), os.path.join(directory, name)))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def latest_checkpoint(directory, prefix=None):
+    checkpoints = list_checkpoints(directory, prefix)
+    return checkpoints[-1] if checkpoints else None
+
+
+class CheckpointWriter:
+    """
+    Saves snapshots with torch.save on a background thread, keeping the newest keep files in directory.
+    Each file is written under a temporary name and then renamed, so a crash never leaves a partial
+    checkpoint behind. A snapshot still waiting when a newer one arrives is replaced by the newer one.
+    """
+    def __init__(self, directory, prefix, keep=3):
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = max(keep, 1)
+        self.pending = None
+        self.skipped = 0
+        self.error = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.thread = None
+
+    def submit(self, snapshot, episode):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        with self.lock:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = (snapshot, episode)
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.write_pending()
+            if self.closing:
+                break
+
+    def write_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is None:
+            return
+        try:
+            self.write(*pending)
+        except Exception as error:
+            self.error = error
+
+    def write(self, snapshot, episode):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{self.prefix}_checkpoint_{episode:07d}.pt")
+        torch.save(snapshot, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        for old_path in list_checkpoints(self.directory, self.prefix)[:-self.keep]:
+            os.remove(old_path)
+
+    def close(self):
+        """
+        Waits until the last submitted snapshot is on disk; a later submit restarts the thread.
+        """
+        if self.thread is not None:
+            self.closing = True
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+            self.closing = False
+            self.write_pending()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+######################################################################
+# Evaluation: batched rollouts of a frozen policy snapshot
+def snapshot_policy(network):
+    """
+    Frozen CPU copy of a policy network that later updates of the original don't touch.
+    """
+    snapshot = copy.deepcopy(network).cpu()
+    freeze_network(snapshot)
+    return snapshot
+
+
+def evaluate_policy(policy, env_factory, n_episodes=100, deterministic=True, num_envs=16, max_steps=500, seed=None):
+    """
+    Runs n_episodes with policy on up to num_envs env wrappers from env_factory (same interface
+    as EnvironmentWrapper) stepped in lockstep, with one batched forward per step. Every copy only
+    starts a new episode while fewer than n_episodes have been started, so short episodes are not
+    over-represented. Padded actions outside each wrapper's action_mask are never taken.
+    Actions are sampled from generators of its own, seeded with seed, so the global RNG streams of a
+    training run evaluating in the background are left alone.
+    Returns (returns, lengths) as numpy arrays in completion order.
+    """
+    gaussian = isinstance(policy, GaussianPolicyNetwork)
+    if gaussian:
+        generator = torch.Generator(device=next(policy.parameters()).device)
+        if seed is not None:
+            generator.manual_seed(seed)
+        else:
+            generator.seed()
+    else:
+        inference = PolicyInference(policy, 'numpy' if PolicyInference.supports_numpy(policy) else 'torch',
+                                    rng=np.random.default_rng(seed))
+    env_wrappers = [env_factory() for _ in range(min(num_envs, n_episodes))]
+    if seed is not None:
+        for i, env_wrapper in enumerate(env_wrappers):
+            env_wrapper.env.reset(seed=seed + i)
+    states = np.stack([env_wrapper.reset() for env_wrapper in env_wrappers])
+    masks = None
+    if not gaussian:
+        # masks at the width of the policy head, which may differ from the wrappers' target_action_size
+        num_actions = inference.logits(states[:1]).shape[-1]
+        masks = [fit_action_mask(getattr(env_wrapper, 'action_mask', None), num_actions) for env_wrapper in env_wrappers]
+        if all(mask is None for mask in masks):
+            masks = None
+        else:
+            masks = np.stack([np.ones(num_actions, dtype=bool) if mask is None else mask for mask in masks])
+    episode_returns = np.zeros(len(env_wrappers))
+    episode_lengths = np.zeros(len(env_wrappers), dtype=np.int64)
+    active = np.ones(len(env_wrappers), dtype=bool)
+    started = len(env_wrappers)
+    returns, lengths = [], []
+
+    while active.any():
+        indices = np.flatnonzero(active)
+        if gaussian:
+            actions = policy.act(states[indices], deterministic, generator)
+        elif deterministic:
+            logits = inference.logits(states[indices])
+            actions = (logits if masks is None else np.where(masks[indices], logits, -np.inf)).argmax(axis=-1)
+        else:
+            actions, _ = inference.sample(states[indices], None if masks is None else masks[indices])
+        for i, action in zip(indices, actions):
+            state, reward, done, _ = env_wrappers[i].step(action if gaussian else int(action))
+            episode_returns[i] += reward
+            episode_lengths[i] += 1
+            states[i] = state
+            # time limits of the env (wrapper.truncated) end an episode as well as max_steps
+            if done or getattr(env_wrappers[i], 'truncated', False) or episode_lengths[i] >= max_steps:
+                returns.append(episode_returns[i])
+                lengths.append(episode_lengths[i])
+                episode_returns[i], episode_lengths[i] = 0, 0
+                if started < n_episodes:
+                    states[i] = env_wrappers[i].reset()
+                    started += 1
+                else:
+                    active[i] = False
+
+    for env_wrapper in env_wrappers:
+        env_wrapper.env.close()
+    return np.array(returns), np.array(lengths)
+
+
+def _evaluate_worker(policy, env_factory, n_episodes, deterministic, num_envs, max_steps, seed):
+    torch.set_num_threads(1)
+    return evaluate_policy(policy, env_factory, n_episodes, deterministic, num_envs, max_steps, seed)
+
+
+def evaluation_summary(returns, lengths, seconds):
+    returns = np.asarray(returns, dtype=np.float64)
+    lengths = np.asarray(lengths, dtype=np.float64)
+    p5, p25, median, p75, p95 = np.percentile(returns, [5, 25, 50, 75, 95])
+    return {'episodes': len(returns), 'mean': float(returns.mean()), 'std': float(returns.std()),
+            'min': float(returns.min()), 'max': float(returns.max()), 'p5': float(p5), 'p25': float(p25),
+            'median': float(median), 'p75': float(p75), 'p95': float(p95),
+            'mean_length': float(lengths.mean()), 'std_length': float(lengths.std()),
+            'returns': returns, 'lengths': lengths, 'seconds': seconds}
+
+
+def evaluate_snapshot(policy, env_factory, n_episodes=100, deterministic=True, num_envs=16, num_workers=0, max_steps=500, seed=None):
+    """
+    evaluate for a policy snapshot that was already taken, e.g. to run it on another thread.
+    """
+    start_time = time()
+    if num_workers <= 0:
+        returns, lengths = evaluate_policy(policy, env_factory, n_episodes, deterministic, num_envs, max_steps, seed)
+    else:
+        shares = [n_episodes // num_workers + (i < n_episodes % num_workers) for i in range(num_workers)]
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = [pool.submit(_evaluate_worker, policy, env_factory, share, deterministic, num_envs, max_steps,
+                                   None if seed is None else seed + i * num_envs)
+                       for i, share in enumerate(shares) if share > 0]
+            outputs = [future.result() for future in futures]
+        returns = np.concatenate([output[0] for output in outputs])
+        lengths = np.concatenate([output[1] for output in outputs])
+    return evaluation_summary(returns, lengths, time() - start_time)
+
+
+def evaluate(agent, env_factory, n_episodes=100, deterministic=True, num_envs=16, num_workers=0, max_steps=500, seed=None):
+    """
+    Evaluates a frozen snapshot of agent.policy_network on n_episodes from env_factory (e.g.
+    lambda: EnvironmentWrapper(gym.make('CartPole-v1'))), greedily unless deterministic=False.
+    With num_workers > 0 the episodes are split over that many processes, each running num_envs
+    envs in lockstep; env_factory must then be picklable. Returns mean/std/min/max/percentiles of
+    the returns, mean/std of the episode lengths, the raw returns and lengths, and the wall time.
+    """
+    return evaluate_snapshot(snapshot_policy(agent.policy_network), env_factory, n_episodes, deterministic, num_envs,
+                             num_workers, max_steps, seed)
+
+######################################################################
+# Trajectories: append-only memory-mapped recording and offline datasets
+def trajectory_columns(meta):
+    """
+    Column name -> (per-step shape, dtype) of a trajectory store described by meta.
+    """
+    return {
+        'states': ((meta['state_size'],), np.dtype(np.float32)),
+        'actions': (tuple(meta['action_shape']), np.dtype(meta['action_dtype'])),
+        'rewards': ((), np.dtype(np.float32)),
+        'dones': ((), np.dtype(np.float32)),
+        'log_probs': ((), np.dtype(np.float32)),
+        'episodes': ((), np.dtype(np.int64)),
+    }
+
+
+def read_episode_index(path, state_size):
+    """
+    (index, final_states) of the finished episodes of a trajectory store: index rows are
+    (episode id, first step, length). Records cut short by a crash are left out.
+    """
+    def load(name, dtype):
+        file = os.path.join(path, name)
+        return np.fromfile(file, dtype=dtype) if os.path.exists(file) else np.zeros(0, dtype=dtype)
+
+    index, final_states = load('episodes.bin', np.int64), load('final_states.bin', np.float32)
+    n = min(len(index) // 3, len(final_states) // state_size)
+    return index[:3 * n].reshape(n, 3), final_states[:n * state_size].reshape(n, state_size)
+
+
+class TrajectoryRecorder:
+    """
+    Streams steps into an append-only columnar store on disk: <path>/chunk_<k>/<column>.npy files of
+    chunk_size rows each (memory-mapped, so nothing accumulates in RAM), see trajectory_columns, plus
+    episodes.bin with (episode id, first step, length) per finished episode and final_states.bin
+    with the state following its last step. Steps only count once end_episode records their episode,
+    so reopening a store (e.g. after a crash or to resume training) appends after the last finished one.
+    Episode ids are numbered by the store, so a run appending to it continues after the last recorded id.
+    Read it with TrajectoryDataset.
+    """
+    def __init__(self, path, state_size=6, action_shape=(), action_dtype=np.int64, chunk_size=65536):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'state_size': state_size, 'action_shape': list(action_shape),
+                         'action_dtype': np.dtype(action_dtype).str, 'chunk_size': chunk_size}
+            with open(meta_path, 'w') as f:
+                json.dump(self.meta, f)
+        self.columns = trajectory_columns(self.meta)
+        self.chunk_size = self.meta['chunk_size']
+        self.index, _ = read_episode_index(path, self.meta['state_size'])
+        self.truncate(len(self.index))
+        self.chunk, self.chunk_id = None, -1
+
+    @property
+    def committed(self):
+        # steps of the finished episodes
+        return int(self.index[-1, 1] + self.index[-1, 2]) if len(self.index) else 0
+
+    def truncate(self, num_episodes):
+        """
+        Keeps the first num_episodes finished episodes and drops everything recorded after them.
+        """
+        num_episodes = min(num_episodes, len(self.index))
+        self.index = self.index[:num_episodes]
+        state_size = self.meta['state_size']
+        for name, record_size in (('episodes.bin', 3 * 8), ('final_states.bin', state_size * 4)):
+            with open(os.path.join(self.path, name), 'ab') as f:
+                f.truncate(num_episodes * record_size)
+        self.size = self.committed
+        # id of the episode being recorded
+        self.episode = int(self.index[-1, 0]) + 1 if len(self.index) else 0
+
+    def discard_episodes_from(self, episode_id):
+        """
+        Drops the trailing episodes with an id of at least episode_id, e.g. those recorded after the checkpoint a run resumes from.
+        """
+        n = len(self.index)
+        while n and self.index[n - 1, 0] >= episode_id:
+            n -= 1
+        self.truncate(n)
+
+    def open_chunk(self, chunk_id):
+        self.flush()
+        directory = os.path.join(self.path, f"chunk_{chunk_id:05d}")
+        os.makedirs(directory, exist_ok=True)
+        self.chunk = {}
+        for name, (shape, dtype) in self.columns.items():
+            file = os.path.join(directory, f"{name}.npy")
+            if os.path.exists(file):
+                self.chunk[name] = np.load(file, mmap_mode='r+')
+            else:
+                self.chunk[name] = np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=(self.chunk_size, *shape))
+        self.chunk_id = chunk_id
+
+    def add(self, state, action, reward, done, log_prob=0.0):
+        chunk_id, row = divmod(self.size, self.chunk_size)
+        if chunk_id != self.chunk_id:
+            self.open_chunk(chunk_id)
+        chunk = self.chunk
+        chunk['states'][row] = state
+        chunk['actions'][row] = action
+        chunk['rewards'][row] = reward
+        chunk['dones'][row] = done
+        chunk['log_probs'][row] = log_prob
+        chunk['episodes'][row] = self.episode
+        self.size += 1
+
+    def end_episode(self, final_state):
+        """
+        Records the episode of the steps added since the last call, with the state that followed them.
+        """
+        start = self.committed
+        if self.size == start:
+            return
+        record = np.array([self.episode, start, self.size - start], dtype=np.int64)
+        final_state = np.asarray(final_state, dtype=np.float32).reshape(self.meta['state_size'])
+        # the index record is written last: it marks the episode as complete
+        with open(os.path.join(self.path, 'final_states.bin'), 'ab') as f:
+            f.write(final_state.tobytes())
+        with open(os.path.join(self.path, 'episodes.bin'), 'ab') as f:
+            f.write(record.tobytes())
+        self.index = np.concatenate([self.index, record[None]])
+        self.episode += 1
+
+    def flush(self):
+        if self.chunk is not None:
+            for column in self.chunk.values():
+                column.flush()
+
+    def close(self):
+        self.flush()
+        self.chunk, self.chunk_id = None, -1
+        self.size = self.committed
+
+
+class TrajectoryDataset:
+    """
+    Read-only view of a TrajectoryRecorder store. Columns stay memory-mapped, so only the rows that are
+    asked for are read from disk. Serves random minibatches of transitions (sample, minibatches) and
+    contiguous episodes (episode, episodes); len() counts the steps of finished episodes.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.columns = trajectory_columns(self.meta)
+        self.chunk_size = self.meta['chunk_size']
+        self.index, self.final_states = read_episode_index(path, self.meta['state_size'])
+        self.size = int(self.index[-1, 1] + self.index[-1, 2]) if len(self.index) else 0
+        self.chunks = {}
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def num_episodes(self):
+        return len(self.index)
+
+    def chunk(self, chunk_id):
+        if chunk_id not in self.chunks:
+            directory = os.path.join(self.path, f"chunk_{chunk_id:05d}")
+            self.chunks[chunk_id] = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in self.columns}
+        return self.chunks[chunk_id]
+
+    def read(self, name, start, stop):
+        """
+        Rows start:stop of a column; a view of the memory map when they sit in one chunk.
+        """
+        parts = []
+        while start < stop:
+            chunk_id, row = divmod(start, self.chunk_size)
+            end = min(stop, (chunk_id + 1) * self.chunk_size)
+            parts.append(self.chunk(chunk_id)[name][row:row + end - start])
+            start = end
+        if len(parts) == 1:
+            return parts[0]
+        shape, dtype = self.columns[name]
+        return np.concatenate(parts) if parts else np.zeros((0, *shape), dtype=dtype)
+
+    def gather(self, name, steps):
+        """
+        The rows of a column at arbitrary step indices, read chunk by chunk.
+        """
+        shape, dtype = self.columns[name]
+        out = np.empty((len(steps), *shape), dtype=dtype)
+        chunk_ids, rows = np.divmod(steps, self.chunk_size)
+        for chunk_id in np.unique(chunk_ids):
+            selected = chunk_ids == chunk_id
+            out[selected] = self.chunk(int(chunk_id))[name][rows[selected]]
+        return out
+
+    def transitions(self, steps):
+        """
+        Dict of states, actions, rewards, next_states, dones, log_probs and episodes at the given steps.
+        A next state is the following step of the same episode, or the episode's final state.
+        """
+        steps = np.asarray(steps, dtype=np.int64)
+        batch = {name: self.gather(name, steps) for name in self.columns}
+        position = np.searchsorted(self.index[:, 1], steps, side='right') - 1
+        last = steps == self.index[position, 1] + self.index[position, 2] - 1
+        next_states = self.final_states[position]
+        if not last.all():
+            next_states[~last] = self.gather('states', steps[~last] + 1)
+        batch['next_states'] = next_states
+        return batch
+
+    def sample(self, batch_size, rng=None):
+        """
+        A minibatch of transitions drawn uniformly with replacement.
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        return self.transitions(np.sort(rng.integers(0, self.size, batch_size)))
+
+    def minibatches(self, batch_size, shuffle=True, rng=None):
+        """
+        One pass over all steps in minibatches of transitions.
+        """
+        steps = np.arange(self.size)
+        if shuffle:
+            (np.random.default_rng() if rng is None else rng).shuffle(steps)
+        for start in range(0, self.size, batch_size):
+            yield self.transitions(np.sort(steps[start:start + batch_size]))
+
+    def episode(self, k):
+        """
+        All columns of the k-th finished episode as contiguous arrays, plus its final_state.
+        """
+        _, start, length = self.index[k]
+        episode = {name: self.read(name, int(start), int(start + length)) for name in self.columns}
+        episode['final_state'] = self.final_states[k]
+        return episode
+
+    def episodes(self):
+        for k in range(self.num_episodes):
+            yield self.episode(k)
+
 ######################################################################
 # 3. Define the Agent
+class PhaseProfiler:
+    """
+    Cumulative wall time and call count per phase of the training loop. Phases are timed with
+    lap(phase, start), which returns the end time so consecutive phases can be chained.
+    On CUDA the device is synchronized first so that kernel time lands in the right phase.
+    """
+    def __init__(self, synchronize=False):
+        self.seconds = {}
+        self.counts = {}
+        self.synchronize = synchronize
+
+    def lap(self, phase, start):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = perf_counter()
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + now - start
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+        return now
+
+    def summary(self):
+        return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+
 Transition = namedtuple("Transition", ["state", "action", "reward", "next_state", "done"])
 
+
+def discounted_scan(deltas, ends, discount):
+    """
+    Reverse scan A_t = deltas_t + discount * (1 - ends_t) * A_{t+1} over the first axis of [steps]
+    or [steps, envs] arrays, with A = 0 after the last step. ends_t marks the last step of an
+    episode, so no sum reaches across an episode boundary.
+    """
+    deltas = np.asarray(deltas, dtype=np.float64)
+    continues = discount * (1 - np.asarray(ends, dtype=np.float64))
+    advantages = np.empty_like(deltas)
+    running = np.zeros(deltas.shape[1:])
+    for t in range(len(deltas) - 1, -1, -1):
+        running = deltas[t] + continues[t] * running
+        advantages[t] = running
+    return advantages
+
+
+def gae_advantages(deltas, ends, gamma, lam):
+    """
+    GAE(lambda) from the one-step TD errors deltas_t = r_t + gamma * V(s'_t) * (1 - done_t) - V(s_t).
+    """
+    return discounted_scan(deltas, ends, gamma * lam)
+
+
+def n_step_advantages(deltas, ends, gamma, n):
+    """
+    n-step advantages sum_{k<n} gamma^k deltas_{t+k}, cut at the end of the episode or rollout.
+    Within an episode the TD errors telescope to the n-step return minus V(s_t). Computed from a
+    single full-length scan S by subtracting gamma^n S_{t+n} where the window stays in one episode.
+    """
+    full = discounted_scan(deltas, ends, gamma)
+    steps = len(full)
+    if n >= steps:
+        return full
+    ends = np.asarray(ends, dtype=np.float64)
+    ended = np.concatenate([np.zeros((1, *ends.shape[1:])), np.cumsum(ends, axis=0)])
+    open_window = (ended[n:steps] - ended[:steps - n]) == 0
+    advantages = full.copy()
+    advantages[:steps - n] -= gamma ** n * full[n:] * open_window
+    return advantages
+
+
+class RolloutBuffer:
+    """
+    Fixed-capacity rollout storage in preallocated float32 columns.
+    next_state is not stored: it is the state column shifted by one, with the state after the
+    last step written by finish(). With num_envs every column gets an extra env axis, and the
+    final observations of truncated episodes are kept aside to bootstrap from.
+    Iterating yields Transitions, so per-transition code keeps working.
+    """
+    def __init__(self, capacity, state_size, action_shape=(), action_dtype=np.int64, num_envs=None):
+        self.capacity = capacity
+        env_shape = () if num_envs is None else (num_envs,)
+        self.states = np.zeros((capacity + 1, *env_shape, state_size), dtype=np.float32)
+        # discrete actions are kept as int64 so they can index the policy output directly
+        self.actions = np.zeros((capacity, *env_shape, *action_shape), dtype=action_dtype)
+        self.rewards = np.zeros((capacity, *env_shape), dtype=np.float32)
+        self.dones = np.zeros((capacity, *env_shape), dtype=np.float32)
+        self.truncated = np.zeros((capacity, *env_shape), dtype=np.float32)
+        self.log_probs = np.zeros((capacity, *env_shape), dtype=np.float32)
+        # frozen-column features of progressive networks, allocated on first use
+        self.features = None
+        self.has_features = False
+        # masks of the real actions when the action layout is padded, allocated on first use
+        self.action_masks = None
+        self.has_action_masks = False
+        self.final_states = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def full(self):
+        return self.size >= self.capacity
+
+    def reset(self):
+        self.size = 0
+        self.has_features = False
+        self.has_action_masks = False
+        self.final_states = {}
+
+    def store_features(self, i, features):
+        if torch.is_tensor(features):
+            features = features.cpu().numpy()
+        if self.features is None:
+            self.features = np.zeros((self.capacity + 1, *self.rewards.shape[1:], features.shape[-1]), dtype=np.float32)
+        self.features[i] = features.reshape(self.features.shape[1:])
+        self.has_features = True
+
+    def store_action_masks(self, rows, action_masks):
+        action_masks = np.asarray(action_masks)
+        if self.action_masks is None:
+            self.action_masks = np.ones((self.capacity, *self.rewards.shape[1:], action_masks.shape[-1]), dtype=bool)
+        if not self.has_action_masks:
+            # steps added before the first mask had every action available
+            self.action_masks[:rows.start] = True
+        self.action_masks[rows] = action_masks
+        self.has_action_masks = True
+
+    def add(self, state, action, reward, done, log_prob=0.0, truncated=None, final_state=None, features=None, action_mask=None):
+        i = self.size
+        if features is not None:
+            self.store_features(i, features)
+        if action_mask is not None:
+            self.store_action_masks(slice(i, i + 1), action_mask)
+        elif self.has_action_masks:
+            self.action_masks[i] = True
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.dones[i] = done
+        if torch.is_tensor(log_prob):
+            log_prob = log_prob.cpu().numpy().reshape(self.log_probs.shape[1:])
+        self.log_probs[i] = log_prob
+        self.truncated[i] = 0 if truncated is None else truncated
+        if final_state is not None:
+            # the next row holds the reset state for these envs, keep the real one aside
+            for env in np.flatnonzero(np.asarray(truncated) & ~np.asarray(done, dtype=bool)):
+                self.final_states[(i, env)] = np.array(final_state[env])
+        self.size += 1
+
+    def finish(self, next_state, features=None):
+        """
+        Stores the state that follows the last added step.
+        """
+        self.states[self.size] = next_state
+        if features is not None:
+            self.store_features(self.size, features)
+
+    def feature_tensor(self, device):
+        """
+        Cached frozen-column features of states[:size + 1], or None when they cannot stand in for
+        a fresh evaluation (not recorded, or next states replaced by truncated final states).
+        """
+        if not self.has_features or self.final_states:
+            return None
+        return torch.from_numpy(self.features[:self.size + 1]).to(device)
+
+    def action_mask_tensor(self, device):
+        """
+        Boolean masks of the real actions over the filled range, or None when nothing was masked.
+        """
+        if not self.has_action_masks:
+            return None
+        return torch.from_numpy(self.action_masks[:self.size]).to(device)
+
+    def tensors(self, device):
+        """
+        Returns (states, actions, rewards, next_states, dones) over the filled range.
+        On CPU these are zero-copy views of the buffer.
+        """
+        n = self.size
+        states = torch.from_numpy(self.states[:n + 1]).to(device)
+        next_states = states[1:]
+        if self.final_states:
+            next_states = next_states.clone()
+            for (i, env), final_state in self.final_states.items():
+                next_states[i, env] = torch.as_tensor(final_state, dtype=torch.float32, device=device)
+        return (states[:n], torch.from_numpy(self.actions[:n]).to(device), torch.from_numpy(self.rewards[:n]).to(device),
+                next_states, torch.from_numpy(self.dones[:n]).to(device))
+
+    def load(self, states, actions, rewards, dones, log_probs, action_masks=None):
+        """
+        Refills the buffer from arrays holding one more state than steps, e.g. a rollout sent by another process.
+        action_masks is per step or one mask for all of them.
+        """
+        n = len(actions)
+        self.reset()
+        if action_masks is not None:
+            self.store_action_masks(slice(0, n), action_masks)
+        self.states[:n + 1] = states
+        self.actions[:n] = actions
+        self.rewards[:n] = rewards
+        self.dones[:n] = dones
+        self.truncated[:n] = 0
+        self.log_probs[:n] = log_probs
+        self.size = n
+
+    def episode_ends(self):
+        """
+        1.0 where an episode ended (terminated or truncated) over the filled range.
+        """
+        return np.maximum(self.dones[:self.size], self.truncated[:self.size])
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield Transition(self.states[i], self.actions[i], self.rewards[i], self.states[i + 1], self.dones[i])
+
 class ActorCriticAgent:
     def __init__(self, config):
         self.device = torch.device(config['device'] if torch.cuda.is_available() else "cpu")
-        self.policy_network = Network(config['state_size'], config['action_size'], config['hidden_sizes'], is_policy=True).to(self.device)
-        self.value_network = Network(config['state_size'], 1, config['hidden_sizes'], is_policy=False).to(self.device)
-        self.optimizer_actor = optim.Adam(self.policy_network.parameters(), lr=config['lr_actor'])
-        self.optimizer_critic = optim.Adam(self.value_network.parameters(), lr=config['lr_critic'])
+        # fused_network: packed weights and an addmm chain instead of nn.Sequential dispatch, see Network.pack
+        self.fused_network = config.get('fused_network', False)
+        self.policy_network = Network(config['state_size'], config['action_size'], config['hidden_sizes'], is_policy=True,
+                                      fused=self.fused_network).to(self.device)
+        self.value_network = Network(config['state_size'], 1, config['hidden_sizes'], is_policy=False, fused=self.fused_network).to(self.device)
+        self.optimizer_actor = self.make_optimizer(self.policy_network, config['lr_actor'])
+        self.optimizer_critic = self.make_optimizer(self.value_network, config['lr_critic'])
+        self.lr_actor, self.lr_critic = config['lr_actor'], config['lr_critic']
+        self.action_size, self.hidden_sizes = config['action_size'], config['hidden_sizes']
         self.verbosity = config['verbosity']
         self.env_name = config['env_name']
-        self.writer = SummaryWriter(f"runs/{config['experiment']}")
+        self.log_dir = f"runs/{config['experiment']}"
+        self.writer = make_metrics_writer(config, self.log_dir)
         self.gamma = config['gamma']
+        self.state_size = config['state_size']
+        self.action_shape, self.action_dtype = (), np.int64
+        # batched update: one forward/backward per network over the whole rollout
+        self.batched_update = config.get('batched_update', True)
+        # advantage estimator of the batched update: 'td' (one-step), 'nstep' or 'gae', see estimate_advantages
+        self.advantage_estimator = config.get('advantage_estimator', 'td')
+        if self.advantage_estimator not in ('td', 'nstep', 'gae'):
+            raise ValueError(f"unknown advantage estimator {self.advantage_estimator}")
+        self.n_steps = config.get('n_steps', 5)
+        self.gae_lambda = config.get('gae_lambda', 0.95)
+        # mask the padded actions of the env wrappers (action_mask) when sampling and in the loss
+        self.mask_actions = config.get('mask_actions', True)
+        # optional fast path for select_action: None (Categorical), 'torch' or 'numpy', see PolicyInference
+        self.inference_backend = config.get('inference_backend')
+        self.inference_compile = config.get('inference_compile')
+        self.inference = None
+        # keep the frozen-column features computed while acting, so updates don't re-run the sources
+        self.cache_column_features = config.get('cache_column_features', True)
+        # optional per-phase timers, and a torch.profiler trace over (first episode, number of episodes)
+        self.profile = config.get('profile', False)
+        self.profile_trace = config.get('profile_trace')
+        self.profiler = None
+        # periodic full-state checkpoints every checkpoint_every episodes (off when None), see train(resume=...)
+        self.checkpoint_every = config.get('checkpoint_every')
+        self.checkpoint_dir = config.get('checkpoint_dir', f"checkpoints/{config['experiment']}")
+        self.checkpointer = CheckpointWriter(self.checkpoint_dir, self.env_name, config.get('checkpoint_keep', 3))
+        # background evaluation of a policy snapshot every eval_every episodes (off when None), see evaluate;
+        # with solve_on_eval the run is solved by the evaluation mean instead of the training Average_100
+        self.eval_every = config.get('eval_every')
+        self.eval_episodes = config.get('eval_episodes', 100)
+        self.eval_num_envs = config.get('eval_num_envs', 16)
+        self.eval_deterministic = config.get('eval_deterministic', True)
+        self.solve_on_eval = config.get('solve_on_eval', False)
+        # stream every step of train into a TrajectoryRecorder store at this path (off when None)
+        self.record_trajectories = config.get('record_trajectories')
+        self.record_chunk_size = config.get('record_chunk_size', 65536)
+
+
+    def make_optimizer(self, network, lr):
+        # fused networks are stepped as one packed tensor
+        if getattr(network, 'fused', False):
+            return PackedAdam(network, lr)
+        return optim.Adam(network.parameters(), lr=lr)
+
+    def refresh_inference(self):
+        """
+        Rebuilds the PolicyInference engine if the policy network was replaced, and syncs its weights.
+        """
+        if self.inference_backend is None:
+            return
+        if self.inference is None or self.inference.network is not self.policy_network:
+            self.inference = PolicyInference(self.policy_network, self.inference_backend, self.inference_compile, self.device)
+        else:
+            self.inference.refresh()
 
+    def shared_columns(self):
+        """
+        The FrozenColumns shared by progressive policy and value networks, if any.
+        """
+        columns = getattr(self.policy_network, 'columns', None)
+        if columns is not None and columns is getattr(self.value_network, 'columns', None):
+            return columns
+        return None
+
+    def acting_features(self):
+        # features of the states the policy just acted on, when they are worth caching
+        columns = self.shared_columns()
+        if columns is None or not self.cache_column_features:
+            return None
+        return columns.last_features
+
+    def next_state_features(self, next_states):
+        columns = self.shared_columns()
+        if columns is None or not self.cache_column_features:
+            return None
+        next_states = torch.as_tensor(next_states, dtype=torch.float32, device=self.device)
+        return columns(next_states.unsqueeze(0) if next_states.dim() == 1 else next_states)
+
+    def env_action_mask(self, env_wrapper):
+        # at the width of the policy head, None when nothing is masked
+        if not self.mask_actions:
+            return None
+        return fit_action_mask(getattr(env_wrapper, 'action_mask', None), self.action_size)
+
+    def select_action(self, state, action_mask=None):
+        if self.inference_backend is not None:
+            if self.inference is None:
+                self.refresh_inference()
+            actions, log_probs = self.inference.sample(state, action_mask)
+            return int(actions[0]), float(log_probs[0])
 
-    def select_action(self, state):
         # without gradients --  test
         with torch.no_grad():
             state = torch.FloatTensor(state).unsqueeze(0).to(self.device)
             probs = self.policy_network(state)
+            if action_mask is not None:
+                # Categorical renormalizes over the real actions
+                probs = probs * torch.as_tensor(action_mask, device=self.device)
             m = Categorical(probs)
             action = m.sample()
 
         return action.item(), m.log_prob(action)
 
+    def select_actions(self, states, action_masks=None):
+        """
+        Samples one action per row of states with a single batched policy forward.
+        """
+        with torch.no_grad():
+            states = torch.as_tensor(states, dtype=torch.float32, device=self.device)
+            probs = self.policy_network(states)
+            if action_masks is not None:
+                probs = probs * torch.as_tensor(action_masks, device=self.device)
+            m = Categorical(probs)
+            actions = m.sample()
+
+        return actions.cpu().numpy(), m.log_prob(actions)
+
+
+    def stack_transitions(self, transitions):
+        """
+        Stacks a list of transitions into contiguous tensors on the agent device.
+        """
+        states, actions, rewards, next_states, dones = zip(*transitions)
+        states = torch.as_tensor(np.array(states), dtype=torch.float32, device=self.device)
+        actions = torch.as_tensor(np.array(actions), device=self.device)
+        rewards = torch.as_tensor(np.array(rewards), dtype=torch.float32, device=self.device)
+        next_states = torch.as_tensor(np.array(next_states), dtype=torch.float32, device=self.device)
+        dones = torch.as_tensor(np.array(dones), dtype=torch.float32, device=self.device)
+        return states, actions, rewards, next_states, dones
+
+    def make_rollout_buffer(self, capacity, num_envs=None):
+        return RolloutBuffer(capacity, self.state_size, self.action_shape, self.action_dtype, num_envs)
 
     def update_policy(self, transitions):
+        # the per-transition update only knows the one-step TD target
+        if not self.batched_update and self.advantage_estimator == 'td':
+            losses = self.update_policy_per_transition(transitions)
+        else:
+            losses = self.update_policy_batched(transitions)
+        self.refresh_inference()
+        return losses
+
+    def action_log_probs(self, states, actions, features=None, action_masks=None):
+        """
+        log pi(actions | states) of a batch, with gradients; features are precomputed frozen-column features.
+        With action_masks the policy is renormalized over the real actions, as it was when sampling.
+        """
+        if features is not None:
+            log_probs = Categorical(self.policy_network(states, features)).logits
+        elif getattr(self.policy_network, 'fused', False):
+            # log-softmax straight from the logits
+            log_probs = self.policy_network.log_probs(states)
+        else:
+            log_probs = Categorical(self.policy_network(states)).logits
+        if action_masks is not None:
+            log_probs = torch.log_softmax(log_probs.masked_fill(~action_masks, float('-inf')), dim=-1)
+        return log_probs.gather(-1, actions.unsqueeze(-1)).squeeze(-1)
+
+    def estimate_advantages(self, transitions, rewards, predicted_values, next_predicted_values, dones):
+        """
+        Returns (advantages, critic targets) for a rollout from detached values. 'td' uses the one-step
+        error r + gamma * V(s') * (1 - done) - V(s); 'nstep' (config['n_steps']) and 'gae'
+        (config['gae_lambda']) scan those errors backwards over the rollout, stopping at episode ends,
+        and the critic then regresses on advantages + V(s), i.e. the n-step or lambda return.
+        """
+        expected_values = rewards + self.gamma * next_predicted_values * (1 - dones)
+        if self.advantage_estimator == 'td':
+            return expected_values - predicted_values, expected_values
+
+        deltas = (expected_values - predicted_values).cpu().numpy()
+        # a list of transitions comes from one contiguous rollout of train, where only dones end episodes
+        ends = transitions.episode_ends() if isinstance(transitions, RolloutBuffer) else dones.cpu().numpy()
+        if self.advantage_estimator == 'gae':
+            advantages = gae_advantages(deltas, ends, self.gamma, self.gae_lambda)
+        else:
+            advantages = n_step_advantages(deltas, ends, self.gamma, self.n_steps)
+        advantages = torch.as_tensor(advantages, dtype=torch.float32, device=self.device)
+        return advantages, advantages + predicted_values
+
+    def update_policy_batched(self, transitions, importance_clip=None):
+        """
+        With importance_clip the rollout is treated as sampled by an older policy: each advantage is
+        weighted by min(importance_clip, pi(a|s) / mu(a|s)), using the log-probs stored in the
+        RolloutBuffer for mu (truncated importance sampling, as in V-trace).
+        """
+        if isinstance(transitions, RolloutBuffer):
+            states, actions, rewards, next_states, dones = transitions.tensors(self.device)
+        else:
+            states, actions, rewards, next_states, dones = self.stack_transitions(transitions)
+        n = states.shape[0]
+        action_masks = transitions.action_mask_tensor(self.device) if isinstance(transitions, RolloutBuffer) else None
+        profiler = self.profiler
+        if profiler is not None:
+            t = perf_counter()
+
+        all_states = torch.cat([states, next_states])
+        columns = self.shared_columns()
+        if columns is None:
+            # one critic forward over states and next states
+            values = self.value_network(all_states).squeeze(-1)
+            log_probs = self.action_log_probs(states, actions, action_masks=action_masks)
+        else:
+            # progressive networks: run the frozen columns at most once for actor and critic together
+            features = transitions.feature_tensor(self.device) if isinstance(transitions, RolloutBuffer) else None
+            if features is None:
+                features = columns(all_states)
+            else:
+                features = torch.cat([features[:n], features[1:]])
+            values = self.value_network(all_states, features).squeeze(-1)
+            log_probs = self.action_log_probs(states, actions, features[:n], action_masks)
+        predicted_values, next_predicted_values = values[:n], values[n:].detach()
+        advantages, expected_values = self.estimate_advantages(transitions, rewards, predicted_values.detach(),
+                                                               next_predicted_values, dones)
+        # sum of squared errors == sum of the per-transition MSELoss terms
+        loss_value = ((predicted_values - expected_values) ** 2).sum()
+
+        if importance_clip is not None:
+            behaviour_log_probs = torch.from_numpy(transitions.log_probs[:n]).to(self.device)
+            advantages = advantages * torch.exp(log_probs.detach() - behaviour_log_probs).clamp(max=importance_clip)
+        loss_policy = -(log_probs * advantages).sum()
+        if profiler is not None:
+            t = profiler.lap('update_forward', t)
+
+        # Backpropagate losses; the two losses share no trainable parameters
+        self.optimizer_actor.zero_grad()
+        self.optimizer_critic.zero_grad()
+        loss_policy.backward()
+        loss_value.backward()
+        if profiler is not None:
+            t = profiler.lap('update_backward', t)
+
+        self.optimizer_actor.step()
+        self.optimizer_critic.step()
+        if profiler is not None:
+            profiler.lap('update_optimizer', t)
+
+        return loss_policy.item(), loss_value.item()
+
+    def pretrain(self, dataset, updates=1000, batch_size=256, clone_policy=True, rng=None):
+        """
+        Warm-starts the networks offline from a TrajectoryDataset, e.g. one recorded on a source task:
+        the critic regresses on one-step TD targets and, with clone_policy, the policy maximizes the
+        log-likelihood of the recorded actions. Returns the mean (policy, value) losses of the last update.
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        loss_policy = torch.zeros(())
+        for _ in range(updates):
+            batch = dataset.sample(batch_size, rng)
+            states, actions, rewards, next_states, dones = (torch.as_tensor(batch[name], device=self.device) for name in
+                                                            ('states', 'actions', 'rewards', 'next_states', 'dones'))
+            values = self.value_network(torch.cat([states, next_states])).squeeze(-1)
+            expected_values = rewards + self.gamma * values[batch_size:].detach() * (1 - dones)
+            loss_value = ((values[:batch_size] - expected_values) ** 2).mean()
+            self.optimizer_critic.zero_grad()
+            loss_value.backward()
+            self.optimizer_critic.step()
+
+            if clone_policy:
+                loss_policy = -self.action_log_probs(states, actions).mean()
+                self.optimizer_actor.zero_grad()
+                loss_policy.backward()
+                self.optimizer_actor.step()
+        self.refresh_inference()
+        return loss_policy.item(), loss_value.item()
+
+    def update_policy_per_transition(self, transitions):
         loss_policy = 0
         loss_value = 0
+        masks = transitions.action_masks if isinstance(transitions, RolloutBuffer) and transitions.has_action_masks else None
 
-        for transition in transitions:
+        for i, transition in enumerate(transitions):
             state, action, reward, next_state, done = transition
             state = torch.FloatTensor(state).unsqueeze(0).to(self.device)
             next_state = torch.FloatTensor(next_state).unsqueeze(0).to(self.device)
@@ -119,6 +1890,8 @@ class ActorCriticAgent:
 
             # compute policy loss
             probs = self.policy_network(state)
+            if masks is not None:
+                probs = probs * torch.as_tensor(masks[i], device=self.device)
             m = Categorical(probs)
             log_prob = m.log_prob(action)
             advantage = expected_value - predicted_value.detach()
@@ -142,10 +1915,37 @@ class ActorCriticAgent:
         torch.save(self.value_network.state_dict(), os.path.join(path, f'{self.env_name}_value_network.pth'))
 
     def load_models(self, path='models', env_name='None'):
+        """
+        Loads both networks from the <env_name>_*_network.pth files in path, or, if path holds
+        checkpoints of env_name (e.g. path=agent.checkpoint_dir), from the latest checkpoint.
+        """
         if env_name == 'None':
             env_name = self.env_name
-        self.policy_network.load_state_dict(torch.load(os.path.join(path, f'{env_name}_policy_network.pth'), map_location=self.device))
-        self.value_network.load_state_dict(torch.load(os.path.join(path, f'{env_name}_value_network.pth'), map_location=self.device))
+        checkpoint_path = latest_checkpoint(path, env_name)
+        if checkpoint_path is not None:
+            checkpoint = torch.load(checkpoint_path, map_location=self.device)
+            self.policy_network.load_state_dict(checkpoint['policy_network'])
+            self.value_network.load_state_dict(checkpoint['value_network'])
+        else:
+            self.policy_network.load_state_dict(torch.load(os.path.join(path, f'{env_name}_policy_network.pth'), map_location=self.device))
+            self.value_network.load_state_dict(torch.load(os.path.join(path, f'{env_name}_value_network.pth'), map_location=self.device))
+        self.refresh_inference()
+
+    def use_progressive_networks(self, source_env_names, path='models'):
+        """
+        Replaces both networks with progressive networks over the frozen policy and value networks
+        saved for source_env_names (e.g. ['Acrobot-v1', 'MountainCarContinuous-v0']), and rebuilds
+        the optimizers for the new trainable parameters.
+        """
+        policy_sources = [load_network(os.path.join(path, f'{env_name}_policy_network.pth'), self.state_size, self.action_size,
+                                       self.hidden_sizes, is_policy=True, device=self.device) for env_name in source_env_names]
+        value_sources = [load_network(os.path.join(path, f'{env_name}_value_network.pth'), self.state_size, 1,
+                                      self.hidden_sizes, is_policy=False, device=self.device) for env_name in source_env_names]
+        self.policy_network, self.value_network = make_progressive_networks(policy_sources, value_sources, self.state_size,
+                                                                            self.action_size, self.hidden_sizes, self.device)
+        self.optimizer_actor = self.make_optimizer(self.policy_network, self.lr_actor)
+        self.optimizer_critic = self.make_optimizer(self.value_network, self.lr_critic)
+        self.refresh_inference()
 
     def reinitialize_output_layers(self, new_action_size):
         """
@@ -153,123 +1953,570 @@ class ActorCriticAgent:
         for the new action size, freezing the hidden layers.
         """
         self.policy_network.reinitialize_output_layer(output_size=new_action_size)
+        self.action_size = new_action_size
         self.value_network.reinitialize_output_layer(output_size=1) # output_size is always 1 for the value network
         self.policy_network.to(self.device)
         self.value_network.to(self.device)
+        # the old optimizers still hold the replaced output layers
+        self.optimizer_actor = self.make_optimizer(self.policy_network, self.lr_actor)
+        self.optimizer_critic = self.make_optimizer(self.value_network, self.lr_critic)
+        self.refresh_inference()
 
 
-    def train(self, env_wrapper, max_episodes=1000, max_steps=500, reward_threshold=475.0, update_frequency=500):
-        self.results = {'Episode': [], 'Reward': [], "Average_100": [], 'Solved': -1, 'Duration': 0, 'Loss': [], 'LossV': []}
+    def new_results(self):
+        return {'Episode': MetricColumn(np.int32), 'Reward': MetricColumn(), "Average_100": MetricColumn(), 'Solved': -1, 'Stopped': -1,
+                'Duration': 0, 'Loss': MetricColumn(), 'LossV': MetricColumn()}
+
+    def record_episode(self, results, episode, episode_reward, reward_threshold):
+        """
+        Appends an episode to results and returns True when Average_100 first passes reward_threshold.
+        """
+        results['Episode'].append(episode)
+        results['Reward'].append(episode_reward)
+        avg_reward = float(np.mean(results['Reward'][-100:], dtype=np.float64))
+        results['Average_100'].append(avg_reward)
+        if len(results['Reward']) >= 100 and avg_reward > reward_threshold and results['Solved'] == -1:
+            results['Solved'] = episode
+            print(f"Solved at episode {episode} with average reward {avg_reward}.")
+            return True
+        return False
+
+    def finish_results(self, results):
+        # hand back plain numpy arrays instead of the growable columns
+        for key, value in results.items():
+            if isinstance(value, MetricColumn):
+                results[key] = value.array()
+        return results
+
+    def record_evaluation(self, results, episode, evaluation, reward_threshold):
+        """
+        Appends an evaluation of the snapshot taken after episode to results and returns True
+        when it solves the run (only with solve_on_eval).
+        """
+        results['Eval_Episode'].append(episode)
+        results['Eval_Mean'].append(evaluation['mean'])
+        results['Eval_Std'].append(evaluation['std'])
+        self.writer.add_scalar("Eval/Mean", evaluation['mean'], episode)
+        self.writer.add_scalar("Eval/Std", evaluation['std'], episode)
+        self.writer.add_scalar("Eval/Median", evaluation['median'], episode)
+        self.writer.add_scalar("Eval/Length", evaluation['mean_length'], episode)
+        if self.solve_on_eval and evaluation['mean'] > reward_threshold and results['Solved'] == -1:
+            results['Solved'] = episode
+            print(f"Solved at episode {episode} with evaluation mean reward {evaluation['mean']}.")
+            return True
+        return False
+
+    def rng_state(self, env_wrapper=None):
+        """
+        Every random stream train draws from. numpy arrays become tensors so that checkpoints
+        hold nothing but tensors and Python primitives.
+        """
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        rng = {'python': random.getstate(), 'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+               'torch': torch.get_rng_state()}
+        if torch.cuda.is_available():
+            rng['cuda'] = torch.cuda.get_rng_state_all()
+        if self.inference is not None:
+            rng['inference'] = self.inference.rng.bit_generator.state
+        env = getattr(env_wrapper, 'env', None)
+        if env is not None:
+            rng['env'] = env.np_random.bit_generator.state
+        if hasattr(env_wrapper, 'get_state'):
+            # episode counters of notebook wrappers, e.g. MCCWrapper.ticker
+            rng['env_wrapper'] = {key: value.item() if isinstance(value, np.number) else value
+                                  for key, value in env_wrapper.get_state().items()}
+        return rng
+
+    def set_rng_state(self, rng, env_wrapper=None):
+        name, keys, pos, has_gauss, cached_gaussian = rng['numpy']
+        np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+        random.setstate(rng['python'])
+        torch.set_rng_state(rng['torch'])
+        if 'cuda' in rng and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng['cuda'])
+        if 'inference' in rng and self.inference is not None:
+            self.inference.rng.bit_generator.state = rng['inference']
+        env = getattr(env_wrapper, 'env', None)
+        if env is not None and 'env' in rng:
+            env.np_random.bit_generator.state = rng['env']
+        if 'env_wrapper' in rng and hasattr(env_wrapper, 'set_state'):
+            env_wrapper.set_state(rng['env_wrapper'])
+
+    def training_state(self, episode, total_steps, results, losses, env_wrapper=None, recorder=None):
+        """
+        Snapshot of everything train needs to continue after episode: both networks and optimizers,
+        results, step counter, last losses, RNG streams and the number of episodes in the trajectory
+        store, copied to the CPU.
+        """
+        return cpu_copy({
+            'env_name': self.env_name,
+            'episode': episode,
+            'total_steps': total_steps,
+            'losses': losses,
+            'policy_network': self.policy_network.state_dict(),
+            'value_network': self.value_network.state_dict(),
+            'optimizer_actor': self.optimizer_actor.state_dict(),
+            'optimizer_critic': self.optimizer_critic.state_dict(),
+            'results': {key: torch.from_numpy(value.array()) if isinstance(value, MetricColumn) else value for key, value in results.items()},
+            'rng': self.rng_state(env_wrapper),
+            'recorded_episodes': None if recorder is None else len(recorder.index),
+        })
+
+    def save_checkpoint(self, episode, total_steps, results, losses, env_wrapper=None, recorder=None):
+        # only the snapshot is taken here; torch.save and rotation run on the checkpointer thread
+        self.checkpointer.submit(self.training_state(episode, total_steps, results, losses, env_wrapper, recorder), episode)
+
+    def load_checkpoint(self, path, env_wrapper=None):
+        """
+        Restores networks, optimizers and RNG streams from a checkpoint and returns it, with the
+        results columns turned back into MetricColumns.
+        """
+        checkpoint = torch.load(path, map_location='cpu')
+        if checkpoint['env_name'] != self.env_name:
+            raise ValueError(f"{path} is a checkpoint for {checkpoint['env_name']}, not {self.env_name}")
+        self.policy_network.load_state_dict(checkpoint['policy_network'])
+        self.value_network.load_state_dict(checkpoint['value_network'])
+        self.optimizer_actor.load_state_dict(checkpoint['optimizer_actor'])
+        self.optimizer_critic.load_state_dict(checkpoint['optimizer_critic'])
+        self.refresh_inference()
+        self.set_rng_state(checkpoint['rng'], env_wrapper)
+        checkpoint['results'] = {key: MetricColumn.from_array(value.numpy()) if isinstance(value, torch.Tensor) else value
+                                 for key, value in checkpoint['results'].items()}
+        return checkpoint
+
+    def start_profiling(self):
+        """
+        Returns (PhaseProfiler, torch.profiler trace) for a training run, both None unless config['profile'].
+        """
+        self.profiler = PhaseProfiler(synchronize=self.device.type == 'cuda') if self.profile else None
+        trace = None
+        if self.profiler is not None and self.profile_trace is not None:
+            first_episode, num_episodes = self.profile_trace
+            trace_path = os.path.join(self.log_dir, 'trace.json')
+            trace = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=max(first_episode - 1, 0), warmup=1, active=num_episodes, repeat=1),
+                on_trace_ready=lambda prof: prof.export_chrome_trace(trace_path))
+            trace.start()
+        return self.profiler, trace
+
+    def log_profile(self, episode):
+        for phase, seconds in self.profiler.seconds.items():
+            self.writer.add_scalar(f"Profile/{phase}", seconds, episode)
+
+    def stop_profiling(self, results, trace):
+        if trace is not None:
+            trace.stop()
+        if self.profiler is not None:
+            results['Profile'] = self.profiler.summary()
+        self.profiler = None
+
+    def train(self, env_wrapper, max_episodes=1000, max_steps=500, reward_threshold=475.0, update_frequency=500, should_stop=None,
+              resume=False, eval_env_factory=None):
+        """
+        resume=True continues from the latest checkpoint in checkpoint_dir (or starts fresh if there is none),
+        resume=<path> from that checkpoint file; max_episodes counts the episodes already trained.
+        eval_env_factory builds the env wrappers for eval_every (default: the class of env_wrapper around
+        gym.make(env_name)). Evaluations run on a background thread and are recorded when they finish.
+        """
+        self.results = self.new_results()
         results = self.results
         start_time = time()
-        episode_rewards = []
         total_steps = 0
-
-        for episode in range(max_episodes):
+        first_episode = 0
+        loss_policy, loss_value = 0.0, 0.0
+        checkpoint_path = resume if isinstance(resume, str) else (latest_checkpoint(self.checkpoint_dir, self.env_name) if resume else None)
+        if checkpoint_path is not None:
+            checkpoint = self.load_checkpoint(checkpoint_path, env_wrapper)
+            self.results = results = checkpoint['results']
+            first_episode, total_steps = checkpoint['episode'] + 1, checkpoint['total_steps']
+            loss_policy, loss_value = checkpoint['losses']
+            start_time -= results['Duration']
+            print(f"Resuming from {checkpoint_path} at episode {first_episode}.")
+        last_checkpoint = first_episode - 1
+        recorder = None
+        if self.record_trajectories:
+            recorder = TrajectoryRecorder(self.record_trajectories, self.state_size, self.action_shape, self.action_dtype,
+                                          self.record_chunk_size)
+            if checkpoint_path is not None and checkpoint.get('recorded_episodes') is not None:
+                # the episodes after the checkpoint are played again
+                recorder.truncate(checkpoint['recorded_episodes'])
+        rollout = self.make_rollout_buffer(update_frequency)
+        profiler, trace = self.start_profiling()
+        if profiler is not None and 'Steps_per_second' not in results:
+            results['Steps_per_second'] = MetricColumn()
+        evaluator, pending_evaluation = None, None
+        if self.eval_every:
+            evaluator = ThreadPoolExecutor(max_workers=1)
+            if eval_env_factory is None:
+                eval_env_factory = lambda: type(env_wrapper)(gym.make(self.env_name))
+            for key, dtype in (('Eval_Episode', np.int32), ('Eval_Mean', np.float32), ('Eval_Std', np.float32)):
+                results.setdefault(key, MetricColumn(dtype))
+        train_threshold = float('inf') if self.solve_on_eval else reward_threshold
+
+        episode = first_episode - 1
+        for episode in range(first_episode, max_episodes):
+            if profiler is not None:
+                episode_start = t = perf_counter()
             state = env_wrapper.reset()
+            action_mask = self.env_action_mask(env_wrapper)
             episode_reward = 0
-            transitions = []
+            rollout.reset()
 
             for step in range(max_steps):
-                action, log_prob = self.select_action(state)
+                action, log_prob = self.select_action(state, action_mask)
+                if profiler is not None:
+                    t = profiler.lap('select_action', t)
                 next_state, reward, done, _ = env_wrapper.step(action)
-                transitions.append(Transition(state, action, reward, next_state, done))
+                total_steps += 1
+                # a time limit of the env, or the end of max_steps: the episode ends but V(next_state) still counts
+                truncated = getattr(env_wrapper, 'truncated', False) or step == max_steps - 1
+                if profiler is not None:
+                    t = profiler.lap('env_step', t)
+                rollout.add(state, action, reward, done, log_prob, truncated, features=self.acting_features(), action_mask=action_mask)
+                if recorder is not None:
+                    recorder.add(state, action, reward, done, float(log_prob))
 
                 episode_reward += reward
                 state = next_state
 
                 # update policy
-                if (len(transitions) >= update_frequency) or done:
-                    loss_policy, loss_value = self.update_policy(transitions)
+                if rollout.full or done or truncated:
+                    rollout.finish(next_state, self.next_state_features(next_state))
+                    if profiler is not None:
+                        t = profiler.lap('rollout', t)
+                    loss_policy, loss_value = self.update_policy(rollout)
                     results['Loss'].append(loss_policy)
                     results['LossV'].append(loss_value)
-                    transitions = [] # should we reset the transitions list here?
+                    rollout.reset()
+                    if profiler is not None:
+                        t = profiler.lap('update', t)
+                elif profiler is not None:
+                    t = profiler.lap('rollout', t)
 
-                if done:
+                if done or truncated:
                     break
 
-            episode_rewards.append(episode_reward)
-
-            results['Episode'].append(episode)
-            results['Reward'].append(episode_reward)
+            if recorder is not None:
+                recorder.end_episode(next_state)
+            if profiler is not None:
+                results['Steps_per_second'].append((step + 1) / (perf_counter() - episode_start))
 
-            if len(episode_rewards) >= 100:
-                avg_reward = sum(episode_rewards[-100:]) / 100
-                results['Average_100'].append(avg_reward)
-                if avg_reward > reward_threshold and results['Solved'] == -1:
-                    results['Solved'] = episode
-                    print(f"Solved at episode {episode} with average reward {avg_reward}.")
-                    break
-            else:
-                results['Average_100'].append(sum(episode_rewards) / len(episode_rewards))
+            if self.record_episode(results, episode, episode_reward, train_threshold):
+                break
 
             if episode % self.verbosity == 0:
                 print(f"Episode {episode}, Avg Reward: {results['Average_100'][-1]}, PLoss: {loss_policy}, VLoss: {loss_value}")
 
+            # collect a finished background evaluation and start the next one on a fresh snapshot
+            if evaluator is not None:
+                if pending_evaluation is not None and pending_evaluation[1].done():
+                    eval_episode, future = pending_evaluation
+                    pending_evaluation = None
+                    if self.record_evaluation(results, eval_episode, future.result(), reward_threshold):
+                        break
+                if pending_evaluation is None and (episode + 1) % self.eval_every == 0:
+                    future = evaluator.submit(evaluate_snapshot, snapshot_policy(self.policy_network), eval_env_factory,
+                                              self.eval_episodes, self.eval_deterministic, self.eval_num_envs, 0, max_steps)
+                    pending_evaluation = (episode, future)
+
             # Log to TensorBoard
+            if profiler is not None:
+                t = perf_counter()
             self.writer.add_scalar("Reward", episode_reward, episode)
             self.writer.add_scalar("Average_100", results['Average_100'][-1], episode)
             self.writer.add_scalar("Loss_Policy", loss_policy, episode)
             self.writer.add_scalar("Loss_Value", loss_value, episode)
+            if profiler is not None:
+                profiler.lap('logging', t)
+                self.writer.add_scalar("Profile/Steps_per_second", results['Steps_per_second'][-1], episode)
+                if episode % self.verbosity == 0:
+                    self.log_profile(episode)
+            if trace is not None:
+                trace.step()
+
+            # optional early termination, e.g. by a sweep that finds this run falling behind
+            if should_stop is not None and should_stop(episode, results):
+                results['Stopped'] = episode
+                print(f"Stopped at episode {episode} with average reward {results['Average_100'][-1]}.")
+                break
+
+            if self.checkpoint_every and (episode + 1) % self.checkpoint_every == 0:
+                results['Duration'] = time() - start_time
+                self.save_checkpoint(episode, total_steps, results, (loss_policy, loss_value), env_wrapper, recorder)
+                last_checkpoint = episode
+
+        if evaluator is not None:
+            # an evaluation still running is abandoned rather than holding up the end of training
+            if pending_evaluation is not None and pending_evaluation[1].done():
+                self.record_evaluation(results, pending_evaluation[0], pending_evaluation[1].result(), reward_threshold)
+            evaluator.shutdown(wait=False)
+
+        self.stop_profiling(results, trace)
+        results['Duration'] = time() - start_time
+        if self.checkpoint_every and episode > last_checkpoint:
+            self.save_checkpoint(episode, total_steps, results, (loss_policy, loss_value), env_wrapper, recorder)
+        self.checkpointer.close()
+        if recorder is not None:
+            recorder.close()
+        self.writer.close()
 
+        return self.finish_results(results)
+
+    def train_vectorized(self, vec_env_wrapper, max_episodes=1000, reward_threshold=475.0, update_frequency=500, should_stop=None):
+        """
+        Trains on all copies of a VectorEnvironmentWrapper at once. Every update uses about
+        update_frequency transitions, split evenly over the copies. Episode bookkeeping is the
+        same as in train, with episodes numbered in the order they finish. The episode length
+        limit comes from the vector env itself (see make_vector_env). Always uses the batched update.
+        should_stop(episode, results) is checked after every episode, as in train.
+        """
+        self.results = self.new_results()
+        results = self.results
+        start_time = time()
+        num_envs = vec_env_wrapper.num_envs
+        steps_per_update = max(1, update_frequency // num_envs)
+        running_rewards = np.zeros(num_envs)
+        loss_policy, loss_value = 0.0, 0.0
+        episode = 0
+        rollout = self.make_rollout_buffer(steps_per_update, num_envs)
+        # the torch.profiler window counts updates here instead of episodes
+        profiler, trace = self.start_profiling()
+
+        states = vec_env_wrapper.reset()
+        action_masks = self.env_action_mask(vec_env_wrapper)
+        while episode < max_episodes and results['Solved'] == -1 and results['Stopped'] == -1:
+            rollout.reset()
+            if profiler is not None:
+                t = perf_counter()
+            for step in range(steps_per_update):
+                actions, log_probs = self.select_actions(states, action_masks)
+                if profiler is not None:
+                    t = profiler.lap('select_action', t)
+                next_states, rewards, dones, truncated, final_states = vec_env_wrapper.step(actions)
+                if profiler is not None:
+                    t = profiler.lap('env_step', t)
+                rollout.add(states, actions, rewards, dones, log_probs, truncated, final_states, self.acting_features(), action_masks)
+                running_rewards += rewards
+                states = next_states
+
+                for i in np.flatnonzero(dones | truncated):
+                    episode_reward = running_rewards[i]
+                    running_rewards[i] = 0
+                    self.record_episode(results, episode, episode_reward, reward_threshold)
+
+                    if episode % self.verbosity == 0:
+                        print(f"Episode {episode}, Avg Reward: {results['Average_100'][-1]}, PLoss: {loss_policy}, VLoss: {loss_value}")
+
+                    # Log to TensorBoard
+                    self.writer.add_scalar("Reward", episode_reward, episode)
+                    self.writer.add_scalar("Average_100", results['Average_100'][-1], episode)
+                    self.writer.add_scalar("Loss_Policy", loss_policy, episode)
+                    self.writer.add_scalar("Loss_Value", loss_value, episode)
+
+                    if should_stop is not None and should_stop(episode, results):
+                        results['Stopped'] = episode
+                        print(f"Stopped at episode {episode} with average reward {results['Average_100'][-1]}.")
+
+                    episode += 1
+                    if episode >= max_episodes or results['Solved'] != -1 or results['Stopped'] != -1:
+                        break
+
+                if profiler is not None:
+                    t = profiler.lap('rollout', t)
+                if episode >= max_episodes or results['Solved'] != -1 or results['Stopped'] != -1:
+                    break
+
+            # update policy on the batched [steps, envs] rollout
+            rollout.finish(states, self.next_state_features(states))
+            loss_policy, loss_value = self.update_policy_batched(rollout)
+            results['Loss'].append(loss_policy)
+            results['LossV'].append(loss_value)
+            if profiler is not None:
+                profiler.lap('update', t)
+                self.log_profile(len(results['Loss']))
+            if trace is not None:
+                trace.step()
+
+        self.stop_profiling(results, trace)
         results['Duration'] = time() - start_time
         self.writer.close()
 
-        return results
+        return self.finish_results(results)
 
 
 class ContinuousActorCriticAgent(ActorCriticAgent):
+    """
+    Actor-critic for Box action spaces with a GaussianPolicyNetwork, e.g. MountainCarContinuous-v0 with
+    action_size 1. config['state_dependent_std'] (default False) and config['log_std_init'] (default 0.0)
+    set up the log-std. Actions are sampled unclipped and clipped to the action bounds by the env wrappers.
+    Always uses the batched update; inference_backend does not apply.
+    """
     def __init__(self, config):
         super().__init__(config)
         # Ensure the policy network is suitable for continuous action spaces
-        self.policy_network = Network(config['state_size'], config['action_size'], config['hidden_sizes'], discrete=False).to(self.device)
+        self.policy_network = GaussianPolicyNetwork(config['state_size'], config['action_size'], config['hidden_sizes'],
+                                                    config.get('state_dependent_std', False), config.get('log_std_init', 0.0)).to(self.device)
+        self.optimizer_actor = self.make_optimizer(self.policy_network, self.lr_actor)
+        self.action_shape, self.action_dtype = (config['action_size'],), np.float32
+        self.batched_update = True
+        self.inference_backend = None
+        self.mask_actions = False
         
-    def select_action(self, state):
-        # Adjust for continuous action space
-        state = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-        action_mean, action_std = self.policy_network(state)
-        dist = Normal(action_mean, action_std.exp())
-        action = dist.sample()
-        log_prob = dist.log_prob(action).sum(-1)
-        return action.cpu().detach().numpy(), log_prob
-
-    def update_policy(self, transitions):
-        loss_policy = 0
-        loss_value = 0
-
-        for transition in transitions:
-            state, action, reward, next_state, done = transition
-            state = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-            next_state = torch.FloatTensor(next_state).unsqueeze(0).to(self.device)
-            action = torch.FloatTensor(action).unsqueeze(0).to(self.device)
-            reward = torch.FloatTensor([reward]).to(self.device)
-            done = torch.FloatTensor([done]).to(self.device)
+    def save_models(self, path='models'):
+        """
+        Also writes <env_name>_policy_network.json with the layout of the Gaussian policy: with a
+        state-dependent log-std its state_dict looks just like a categorical Network (see serve.load_policy).
+        """
+        super().save_models(path)
+        metadata = {'policy': 'gaussian', 'action_size': self.policy_network.action_size,
+                    'state_dependent_std': self.policy_network.state_dependent_std}
+        with open(os.path.join(path, f'{self.env_name}_policy_network.json'), 'w') as f:
+            json.dump(metadata, f)
 
-            # Compute value loss as before
-            predicted_value = self.value_network(state)
-            next_predicted_value = self.value_network(next_state)
-            expected_value = reward + self.gamma * next_predicted_value * (1 - done)
-            loss_value += nn.MSELoss()(predicted_value.squeeze(), expected_value.detach().squeeze())
+    def select_action(self, state, action_mask=None):
+        actions, log_probs = self.select_actions(np.asarray(state)[None])
+        return actions[0], log_probs[0].item()
 
-            # Adjust policy loss computation for continuous action space
-            action_mean, action_std = self.policy_network(state)
-            dist = Normal(action_mean, action_std.exp())
-            log_prob = dist.log_prob(action).sum(-1, keepdim=True)
-            advantage = expected_value - predicted_value.detach()
-            loss_policy += (-log_prob * advantage).mean()
+    def select_actions(self, states, action_masks=None):
+        # Adjust for continuous action space
+        with torch.no_grad():
+            states = torch.as_tensor(states, dtype=torch.float32, device=self.device)
+            dist = self.policy_network.distribution(states)
+            actions = dist.sample()
+            log_probs = dist.log_prob(actions).sum(-1)
+        return actions.cpu().numpy(), log_probs
+
+    def action_log_probs(self, states, actions, features=None, action_masks=None):
+        return self.policy_network.distribution(states).log_prob(actions).sum(-1)
+    
 
-        # Perform backpropagation and optimization as before
-        self.optimizer_actor.zero_grad()
-        loss_policy.backward()
-        self.optimizer_actor.step()
 
-        self.optimizer_critic.zero_grad()
-        loss_value.backward()
-        self.optimizer_critic.step()
+class MultiTaskActorCriticAgent(ActorCriticAgent):
+    """
+    One agent trained on several tasks at once, config['tasks'] being their env names. Policy and value
+    are MultiHeadNetworks: the hidden trunk is shared and every task has its own output head. train steps
+    one env wrapper per task in lockstep with a single batched forward, and every update is one batched
+    forward/backward over the mixed-task [steps, tasks] rollout. Per-task metrics are kept in
+    results['Tasks'][env_name], with the columns of the results of ActorCriticAgent.train.
+    """
+    def __init__(self, config):
+        if config.get('inference_backend') == 'numpy':
+            raise ValueError("MultiTaskActorCriticAgent does not support the numpy inference backend, use 'torch' or None")
+        super().__init__(dict(config, env_name=config.get('env_name', 'MultiTask'), fused_network=False))
+        self.tasks = list(config['tasks'])
+        self.policy_network = MultiHeadNetwork(config['state_size'], config['action_size'], len(self.tasks), config['hidden_sizes'],
+                                               is_policy=True).to(self.device)
+        self.value_network = MultiHeadNetwork(config['state_size'], 1, len(self.tasks), config['hidden_sizes'],
+                                              is_policy=False).to(self.device)
+        self.optimizer_actor = self.make_optimizer(self.policy_network, self.lr_actor)
+        self.optimizer_critic = self.make_optimizer(self.value_network, self.lr_critic)
 
-        return loss_policy.item(), loss_value.item()
-    
+    def save_models(self, path='models'):
+        """
+        Saves the multi-head networks under env_name, and every task as plain <task>_*_network.pth files
+        in the <path>/<env_name> subdirectory, so the single-task models in path are never overwritten.
+        Load a task with load_models(os.path.join(path, env_name), task).
+        """
+        super().save_models(path)
+        task_path = os.path.join(path, self.env_name)
+        os.makedirs(task_path, exist_ok=True)
+        for task, env_name in enumerate(self.tasks):
+            torch.save(self.policy_network.task_network(task).state_dict(), os.path.join(task_path, f'{env_name}_policy_network.pth'))
+            torch.save(self.value_network.task_network(task).state_dict(), os.path.join(task_path, f'{env_name}_value_network.pth'))
+
+    def check_env_wrappers(self, env_wrappers):
+        """
+        Raises a ValueError unless there is one wrapper per task and each one offers discrete actions
+        the policy heads can take. Continuous envs need a discretizing wrapper (one with a discretize_action
+        method, e.g. MCCWrapper), a plain EnvironmentWrapper would leave them a single padded action.
+        """
+        if len(env_wrappers) != len(self.tasks):
+            raise ValueError(f"expected one env wrapper per task ({len(self.tasks)}), got {len(env_wrappers)}")
+        for env_name, env_wrapper in zip(self.tasks, env_wrappers):
+            env = getattr(env_wrapper, 'env', None)
+            if isinstance(getattr(env, 'action_space', None), gym.spaces.Box) and not hasattr(env_wrapper, 'discretize_action'):
+                raise ValueError(f"{env_name} has a continuous action space, wrap it in a discretizing wrapper such as MCCWrapper")
+            if not isinstance(env_wrapper.action_space, (int, np.integer)) or not 1 < env_wrapper.action_space <= self.action_size:
+                raise ValueError(f"{env_name} needs between 2 and {self.action_size} discrete actions, its wrapper has {env_wrapper.action_space}")
+
+    def train(self, env_wrappers, max_episodes=1000, max_steps=500, reward_thresholds=None, update_frequency=500):
+        """
+        env_wrappers holds one wrapper per task, in the order of config['tasks']; max_episodes, max_steps
+        and reward_thresholds are lists with one entry per task, or one value for all of them. Tasks that are
+        solved or past max_episodes keep training (and recording episodes) so that the shared trunk keeps
+        serving them; the run ends once every task is solved or has finished max_episodes. results['Solved']
+        maps every env name to the episode of that task at which it was solved, or -1.
+        """
+        self.check_env_wrappers(env_wrappers)
+        num_tasks = len(self.tasks)
+        per_task = lambda value: list(value) if isinstance(value, (list, tuple)) else [value] * num_tasks
+        max_episodes, max_steps = per_task(max_episodes), per_task(max_steps)
+        reward_thresholds = per_task(float('inf') if reward_thresholds is None else reward_thresholds)
+        self.results = {'Tasks': {env_name: self.new_results() for env_name in self.tasks},
+                        'Solved': {env_name: -1 for env_name in self.tasks}, 'Stopped': -1,
+                        'Duration': 0, 'Loss': MetricColumn(), 'LossV': MetricColumn()}
+        results = self.results
+        task_results = [results['Tasks'][env_name] for env_name in self.tasks]
+        start_time = time()
+        loss_policy, loss_value = 0.0, 0.0
+        rollout = self.make_rollout_buffer(max(1, update_frequency // num_tasks), num_tasks)
+
+        states = np.stack([env_wrapper.reset() for env_wrapper in env_wrappers]).astype(np.float32)
+        next_states = np.empty_like(states)
+        masks = [self.env_action_mask(env_wrapper) for env_wrapper in env_wrappers]
+        action_masks = None
+        if any(mask is not None for mask in masks):
+            action_masks = np.stack([np.ones(self.action_size, dtype=bool) if mask is None else mask for mask in masks])
+        rewards = np.zeros(num_tasks, dtype=np.float32)
+        dones, truncated = np.zeros(num_tasks, dtype=bool), np.zeros(num_tasks, dtype=bool)
+        episode_rewards, episode_steps = np.zeros(num_tasks), np.zeros(num_tasks, dtype=np.int64)
+        episodes = np.zeros(num_tasks, dtype=np.int64)
+
+        def finished(task):
+            return task_results[task]['Solved'] != -1 or episodes[task] >= max_episodes[task]
+
+        while not all(finished(task) for task in range(num_tasks)):
+            rollout.reset()
+            while not rollout.full:
+                actions, log_probs = self.select_actions(states, action_masks)
+                for task, env_wrapper in enumerate(env_wrappers):
+                    next_states[task], rewards[task], dones[task], _ = env_wrapper.step(actions[task])
+                    episode_steps[task] += 1
+                    truncated[task] = getattr(env_wrapper, 'truncated', False) or episode_steps[task] >= max_steps[task]
+                # next_states holds the true next states; states continues with the reset ones
+                rollout.add(states, actions, rewards, dones, log_probs, truncated, next_states, action_mask=action_masks)
+                states[:] = next_states
+                episode_rewards += rewards
+
+                for task in np.flatnonzero(dones | truncated):
+                    env_name, episode = self.tasks[task], int(episodes[task])
+                    if self.record_episode(task_results[task], episode, episode_rewards[task], reward_thresholds[task]):
+                        print(f"{env_name} solved.")
+                        results['Solved'][env_name] = task_results[task]['Solved']
+                    if episode % self.verbosity == 0:
+                        print(f"{env_name} episode {episode}, Avg Reward: {task_results[task]['Average_100'][-1]}, "
+                              f"PLoss: {loss_policy}, VLoss: {loss_value}")
+                    self.writer.add_scalar(f"{env_name}/Reward", episode_rewards[task], episode)
+                    self.writer.add_scalar(f"{env_name}/Average_100", task_results[task]['Average_100'][-1], episode)
+                    episodes[task] += 1
+                    episode_rewards[task], episode_steps[task] = 0, 0
+                    states[task] = env_wrappers[task].reset()
+
+            # one update over the mixed-task rollout
+            rollout.finish(states)
+            loss_policy, loss_value = self.update_policy_batched(rollout)
+            self.refresh_inference()
+            results['Loss'].append(loss_policy)
+            results['LossV'].append(loss_value)
+            self.writer.add_scalar("Loss_Policy", loss_policy, len(results['Loss']))
+            self.writer.add_scalar("Loss_Value", loss_value, len(results['Loss']))
 
+        results['Duration'] = time() - start_time
+        self.writer.close()
+        for task_result in task_results:
+            task_result['Duration'] = results['Duration']
+            self.finish_results(task_result)
+        return self.finish_results(results)
 
 
 ###################################################################
@@ -0,0 +1,172 @@
+import copy
+import queue
+from time import time
+
+import gymnasium as gym
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from actorcritic import EnvironmentWrapper, PolicyInference, RolloutBuffer, fit_action_mask
+
+######################################################################
+# 1. Rollout workers
+def rollout_worker(worker_id, env_name, make_env_wrapper, shared_policy, policy_version, policy_lock,
+                   trajectories, stop, state_size, rollout_length, max_steps, seed, mask_actions=True):
+    """
+    Acts with a local copy of the learner's policy, refreshed whenever the learner has published
+    a newer version, and sends rollouts (cut at update_frequency steps or at episode end, like train)
+    to the learner together with the policy version that sampled them and the action mask of the env.
+    """
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    env = gym.make(env_name)
+    env.reset(seed=seed)
+    env_wrapper = make_env_wrapper(env) if make_env_wrapper is not None else EnvironmentWrapper(env)
+
+    policy = copy.deepcopy(shared_policy)
+    inference = PolicyInference(policy, 'numpy' if PolicyInference.supports_numpy(policy) else 'torch')
+    version = -1
+    rollout = RolloutBuffer(rollout_length, state_size)
+    action_mask = None
+    if mask_actions:
+        # at the width of the policy head, which may be narrower than the wrapper's target_action_size
+        num_actions = inference.logits(np.zeros((1, state_size), dtype=np.float32)).shape[-1]
+        action_mask = fit_action_mask(env_wrapper.action_mask, num_actions)
+
+    def refresh():
+        nonlocal version
+        if policy_version.value != version:
+            with policy_lock:
+                policy.load_state_dict(shared_policy.state_dict())
+                version = policy_version.value
+            inference.refresh()
+
+    def send(message):
+        # never block forever on a full queue once the learner is done
+        while not stop.is_set():
+            try:
+                trajectories.put(message, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    while not stop.is_set():
+        state = env_wrapper.reset()
+        episode_reward = 0
+        rollout.reset()
+        refresh()
+
+        for step in range(max_steps):
+            actions, log_probs = inference.sample(state, action_mask)
+            action = int(actions[0])
+            next_state, reward, done, _ = env_wrapper.step(action)
+            rollout.add(state, action, reward, done, log_probs[0])
+            episode_reward += reward
+            state = next_state
+
+            truncated = getattr(env_wrapper, 'truncated', False)
+            episode_over = done or truncated or step == max_steps - 1
+            if rollout.full or episode_over:
+                rollout.finish(next_state)
+                n = rollout.size
+                send((worker_id, version, torch.tensor(rollout.states[:n + 1]), torch.tensor(rollout.actions[:n]),
+                      torch.tensor(rollout.rewards[:n]), torch.tensor(rollout.dones[:n]),
+                      torch.tensor(rollout.log_probs[:n]), action_mask, episode_reward if episode_over else None))
+                rollout.reset()
+                refresh()
+
+            if done or truncated or stop.is_set():
+                break
+
+    env.close()
+
+######################################################################
+# 2. Central learner
+def train_async(agent, env_name, num_workers=4, max_episodes=1000, max_steps=500, reward_threshold=475.0,
+                update_frequency=500, max_staleness=4, importance_clip=1.0, make_env_wrapper=None, seed=0,
+                start_method='spawn'):
+    """
+    IMPALA/A3C-style training: num_workers processes run environments with a periodically refreshed
+    copy of agent.policy_network and push rollouts through a shared-memory queue; this process owns
+    the optimizers and updates on rollouts in arrival order. Rollouts sampled more than max_staleness
+    updates ago are dropped, the rest are corrected with truncated importance weights (importance_clip).
+    Episodes are numbered in the order they finish. make_env_wrapper must be picklable.
+    Returns the same results dict as agent.train, plus the number of dropped rollouts under 'Dropped'.
+    """
+    agent.results = dict(agent.new_results(), Dropped=0)
+    results = agent.results
+    start_time = time()
+    loss_policy, loss_value = 0.0, 0.0
+
+    ctx = mp.get_context(start_method)
+    # workers read the weights from a CPU copy in shared memory, published after every update
+    shared_policy = copy.deepcopy(agent.policy_network).cpu().share_memory()
+    policy_version = ctx.Value('i', 0)
+    policy_lock = ctx.Lock()
+    trajectories = ctx.Queue(maxsize=2 * num_workers)
+    stop = ctx.Event()
+
+    workers = [ctx.Process(target=rollout_worker, daemon=True,
+                           args=(worker_id, env_name, make_env_wrapper, shared_policy, policy_version, policy_lock,
+                                 trajectories, stop, agent.state_size, update_frequency, max_steps, seed + worker_id,
+                                 agent.mask_actions))
+               for worker_id in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    rollout = agent.make_rollout_buffer(update_frequency)
+    version = 0
+    episode = 0
+    try:
+        while episode < max_episodes and results['Solved'] == -1:
+            try:
+                worker_id, behaviour_version, states, actions, rewards, dones, log_probs, action_mask, episode_reward = trajectories.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError("all rollout workers exited")
+                continue
+
+            if version - behaviour_version > max_staleness:
+                results['Dropped'] += 1
+            else:
+                rollout.load(states.numpy(), actions.numpy(), rewards.numpy(), dones.numpy(), log_probs.numpy(), action_mask)
+                loss_policy, loss_value = agent.update_policy_batched(rollout, importance_clip=importance_clip)
+                results['Loss'].append(loss_policy)
+                results['LossV'].append(loss_value)
+
+                with policy_lock:
+                    shared_policy.load_state_dict(agent.policy_network.state_dict())
+                    version += 1
+                    policy_version.value = version
+
+            if episode_reward is None:
+                continue
+
+            agent.record_episode(results, episode, episode_reward, reward_threshold)
+
+            if episode % agent.verbosity == 0:
+                print(f"Episode {episode}, Avg Reward: {results['Average_100'][-1]}, PLoss: {loss_policy}, VLoss: {loss_value}")
+
+            # Log to TensorBoard
+            agent.writer.add_scalar("Reward", episode_reward, episode)
+            agent.writer.add_scalar("Average_100", results['Average_100'][-1], episode)
+            agent.writer.add_scalar("Loss_Policy", loss_policy, episode)
+            agent.writer.add_scalar("Loss_Value", loss_value, episode)
+            episode += 1
+    finally:
+        stop.set()
+        # drain so that no worker is left blocked on a full queue; tensors from workers
+        # that already exited can no longer be rebuilt and are simply discarded
+        while any(worker.is_alive() for worker in workers):
+            try:
+                trajectories.get(timeout=0.1)
+            except (queue.Empty, OSError):
+                pass
+        for worker in workers:
+            worker.join()
+
+    results['Duration'] = time() - start_time
+    agent.writer.close()
+
+    return agent.finish_results(results)
@@ -0,0 +1,401 @@
+import argparse
+import json
+import os
+import platform
+import sys
+from time import perf_counter
+
+import gymnasium as gym
+import numpy as np
+import torch
+
+from actorcritic import ActorCriticAgent, EnvironmentWrapper, Network, VectorEnvironmentWrapper, evaluate, make_vector_env
+
+BENCHMARK_CONFIG = {
+    'experiment': 'benchmark',
+    'device': 'cpu',
+    'state_size': 6,
+    'action_size': 3,
+    'hidden_sizes': [64, 64],
+    'lr_actor': 0.001,
+    'lr_critic': 0.005,
+    'verbosity': 10 ** 9,
+    'env_name': 'CartPole-v1',
+    'gamma': 0.99,
+    'metrics_backend': 'none',
+}
+
+# env name -> (reward_threshold, max_steps), as in the training notebooks
+ENVIRONMENTS = {
+    'CartPole-v1': (475.0, 500),
+    'Acrobot-v1': (-85.0, 200),
+    'MountainCarContinuous-v0': (80.0, 500),
+}
+
+# machine specific: regenerate with --save-baseline on the node the numbers are compared on
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+######################################################################
+# 1. Timing helpers and env wrappers
+def time_per_call(fn, repeats, warmup=100):
+    """
+    Best over 5 runs of the mean wall time of fn() in microseconds (the minimum is the least
+    noisy estimate, as in timeit).
+    """
+    for _ in range(warmup):
+        fn()
+    runs = []
+    for _ in range(5):
+        start = perf_counter()
+        for _ in range(repeats):
+            fn()
+        runs.append((perf_counter() - start) / repeats * 1e6)
+    return float(min(runs))
+
+
+def seed_everything(seed, env=None):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if env is not None:
+        env.reset(seed=seed)
+        env.action_space.seed(seed)
+
+
+class CountingEnvironmentWrapper(EnvironmentWrapper):
+    """
+    EnvironmentWrapper that counts env steps. MountainCarContinuous gets the 3 discrete
+    actions of train_mcc.ipynb mapped onto [-1, 1], without reward shaping.
+    """
+    state_attributes = ('steps',)
+
+    def __init__(self, env, target_state_size=6, target_action_size=3):
+        super().__init__(env, target_state_size, target_action_size)
+        self.steps = 0
+        self.continuous = isinstance(env.action_space, gym.spaces.Box)
+        if self.continuous:
+            self.action_space = target_action_size
+            self.action_boundaries = np.linspace(-1, 1, target_action_size)
+
+    def step(self, action):
+        self.steps += 1
+        if not self.continuous:
+            return super().step(action)
+        state, reward, done, _, info = self.env.step([self.discretize_action(action)])
+        return self.pad(state), reward, done, info
+
+    def discretize_action(self, action):
+        return self.action_boundaries[min(self.action_space - 1, max(0, action))]
+
+
+class CountingVectorEnvironmentWrapper(VectorEnvironmentWrapper):
+    def __init__(self, envs, target_state_size=6, target_action_size=3):
+        super().__init__(envs, target_state_size, target_action_size)
+        self.steps = 0
+
+    def step(self, actions):
+        self.steps += self.num_envs
+        return super().step(actions)
+
+
+def make_agent(env_name, **overrides):
+    return ActorCriticAgent(dict(BENCHMARK_CONFIG, env_name=env_name, **overrides))
+
+
+def make_env_wrapper(env_name, seed=0):
+    env = gym.make(env_name, max_episode_steps=ENVIRONMENTS[env_name][1])
+    seed_everything(seed, env)
+    return CountingEnvironmentWrapper(env)
+
+######################################################################
+# 2. Micro benchmarks
+SELECT_ACTION_PATHS = {
+    'categorical': {},
+    'fused': {'fused_network': True},
+    'torch': {'inference_backend': 'torch'},
+    'torch_script': {'inference_backend': 'torch', 'inference_compile': 'script'},
+    'numpy': {'inference_backend': 'numpy'},
+}
+
+
+def bench_select_action(repeats=2000, seed=0):
+    """
+    Microseconds per ActorCriticAgent.select_action call for the default Categorical path and
+    every PolicyInference backend, on the same float64 padded state the env wrapper produces.
+    """
+    torch.manual_seed(seed)
+    state = np.random.default_rng(seed).normal(size=BENCHMARK_CONFIG['state_size'])
+    timings = {}
+    for name, overrides in SELECT_ACTION_PATHS.items():
+        agent = make_agent('CartPole-v1', **overrides)
+        timings[name] = time_per_call(lambda: agent.select_action(state), repeats)
+        agent.writer.close()
+    return timings
+
+
+def bench_network(batch_sizes=(1, 500), repeats=2000, seed=0):
+    """
+    Microseconds per forward and per forward+backward of a [64, 64] policy Network, with the
+    nn.Sequential modules and in fused mode.
+    """
+    timings = {}
+    for fused in (False, True):
+        torch.manual_seed(seed)
+        network = Network(BENCHMARK_CONFIG['state_size'], BENCHMARK_CONFIG['action_size'], BENCHMARK_CONFIG['hidden_sizes'], fused=fused)
+        mode = 'fused' if fused else 'sequential'
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, BENCHMARK_CONFIG['state_size'])
+            n = max(20, repeats // batch_size)
+
+            def forward():
+                with torch.no_grad():
+                    network(x)
+
+            def forward_backward():
+                network(x)[:, 0].sum().backward()
+
+            timings[f'{mode}/forward/{batch_size}'] = time_per_call(forward, n)
+            timings[f'{mode}/forward_backward/{batch_size}'] = time_per_call(forward_backward, n)
+    return timings
+
+
+def bench_update_policy(update_frequencies=(50, 200, 500, 2000), repeats=20, seed=0):
+    """
+    Microseconds per batched update_policy call on a full RolloutBuffer of each size, with the
+    default networks and with fused networks (keys 'fused/<size>').
+    """
+    timings = {}
+    for prefix, overrides in (('', {}), ('fused/', {'fused_network': True})):
+        rng = np.random.default_rng(seed)
+        for update_frequency in update_frequencies:
+            torch.manual_seed(seed)
+            agent = make_agent('CartPole-v1', **overrides)
+            rollout = agent.make_rollout_buffer(update_frequency)
+            for _ in range(update_frequency):
+                rollout.add(rng.normal(size=6), rng.integers(3), 1.0, rng.random() < 0.02)
+            rollout.finish(rng.normal(size=6))
+            timings[f'{prefix}{update_frequency}'] = time_per_call(lambda: agent.update_policy(rollout), repeats, warmup=3)
+            agent.writer.close()
+    return timings
+
+
+def bench_env_step(repeats=5000, seed=0):
+    """
+    Microseconds per EnvironmentWrapper.step (resets amortized in) with random actions.
+    """
+    rng = np.random.default_rng(seed)
+    timings = {}
+    for env_name in ENVIRONMENTS:
+        env_wrapper = make_env_wrapper(env_name, seed)
+        env_wrapper.reset()
+
+        def step():
+            _, _, done, _ = env_wrapper.step(int(rng.integers(3)))
+            if done or env_wrapper.steps % ENVIRONMENTS[env_name][1] == 0:
+                env_wrapper.reset()
+
+        timings[env_name] = time_per_call(step, repeats)
+        env_wrapper.env.close()
+    return timings
+
+
+def bench_evaluate(n_episodes=100, num_envs=16, seed=0):
+    """
+    Wall-clock seconds to run n_episodes of CartPole with an untrained policy: one select_action
+    per env step (serial) vs evaluate with num_envs envs in lockstep, both sampling stochastically.
+    """
+    seed_everything(seed)
+    agent = make_agent('CartPole-v1')
+    max_steps = ENVIRONMENTS['CartPole-v1'][1]
+    env_wrapper = make_env_wrapper('CartPole-v1', seed)
+    start = perf_counter()
+    for _ in range(n_episodes):
+        state = env_wrapper.reset()
+        for _ in range(max_steps):
+            action, _ = agent.select_action(state)
+            state, _, done, _ = env_wrapper.step(action)
+            if done:
+                break
+    serial = perf_counter() - start
+    batched = evaluate(agent, lambda: make_env_wrapper('CartPole-v1'), n_episodes, deterministic=False,
+                       num_envs=num_envs, max_steps=max_steps, seed=seed)['seconds']
+    return {'serial': serial, 'batched': batched}
+
+######################################################################
+# 3. Macro benchmarks
+def bench_training_throughput(episodes=30, num_envs=8, seed=0, **overrides):
+    """
+    Env steps per second of agent.train (and of agent.train_vectorized with num_envs copies) for
+    a fixed number of episodes from a fixed seed, with each env's notebook update_frequency.
+    """
+    throughput = {}
+    for env_name, (reward_threshold, max_steps) in ENVIRONMENTS.items():
+        seed_everything(seed)
+        agent = make_agent(env_name, **overrides)
+        env_wrapper = make_env_wrapper(env_name, seed)
+        results = agent.train(env_wrapper, max_episodes=episodes, max_steps=max_steps,
+                              reward_threshold=float('inf'), update_frequency=max_steps)
+        throughput[f'train/{env_name}'] = env_wrapper.steps / results['Duration']
+
+        if env_name == 'MountainCarContinuous-v0':
+            continue  # the vector path has no discretized MountainCar wrapper
+        seed_everything(seed)
+        agent = make_agent(env_name, **overrides)
+        vec_env_wrapper = CountingVectorEnvironmentWrapper(make_vector_env(env_name, num_envs, max_steps=max_steps))
+        vec_env_wrapper.reset(seed=seed)
+        results = agent.train_vectorized(vec_env_wrapper, max_episodes=episodes, reward_threshold=float('inf'),
+                                         update_frequency=max_steps)
+        throughput[f'train_vectorized/{env_name}'] = vec_env_wrapper.steps / results['Duration']
+        vec_env_wrapper.close()
+    return throughput
+
+
+def bench_time_to_solve(env_names=('CartPole-v1', 'Acrobot-v1'), seeds=(0, 1, 2), max_episodes=2000, **overrides):
+    """
+    Wall-clock seconds and env steps until Average_100 passes reward_threshold, per env, as the
+    median over the seeds that solved. Unsolved seeds are counted but not timed.
+    """
+    solve = {}
+    for env_name in env_names:
+        reward_threshold, max_steps = ENVIRONMENTS[env_name]
+        durations, steps = [], []
+        for seed in seeds:
+            seed_everything(seed)
+            agent = make_agent(env_name, **overrides)
+            env_wrapper = make_env_wrapper(env_name, seed)
+            results = agent.train(env_wrapper, max_episodes=max_episodes, max_steps=max_steps,
+                                  reward_threshold=reward_threshold, update_frequency=max_steps)
+            if results['Solved'] != -1:
+                durations.append(results['Duration'])
+                steps.append(env_wrapper.steps)
+        solve[env_name] = {
+            'seconds': float(np.median(durations)) if durations else None,
+            'steps': float(np.median(steps)) if steps else None,
+            'solved': len(durations),
+            'seeds': len(seeds),
+        }
+    return solve
+
+######################################################################
+# 4. Suite, baseline and regression check
+def summarize(values, unit, better):
+    """
+    Median of the repeated measurements of a metric, with their spread: the median absolute deviation
+    scaled to a standard deviation (1.4826 MAD) relative to the median, which a single outlying run
+    barely moves.
+    """
+    median = float(np.median(values))
+    mad = float(np.median(np.abs(np.asarray(values) - median)))
+    spread = 1.4826 * mad / abs(median) if median else 0.0
+    return {'value': median, 'spread': float(spread), 'repeats': len(values), 'unit': unit, 'better': better}
+
+
+def run_suite(quick=False, solve=False, repeats=5):
+    """
+    Runs the benchmarks repeats times and returns {'meta': ..., 'metrics': {name: {'value', 'spread', 'repeats',
+    'unit', 'better'}}}, see summarize. quick only shortens the timing loops of the micro benchmarks; the
+    training throughput keeps its episode count, since steps per second depend on how long the episodes get.
+    The time to solve is measured once, as a median over seeds.
+    """
+    scale = 0.2 if quick else 1.0
+    samples, kinds = {}, {}
+
+    def record(name, value, unit, better):
+        samples.setdefault(name, []).append(value)
+        kinds[name] = (unit, better)
+
+    for _ in range(repeats):
+        for path, value in bench_select_action(repeats=int(2000 * scale)).items():
+            record(f'select_action/{path}', value, 'us', 'lower')
+        for name, value in bench_network(repeats=int(2000 * scale)).items():
+            record(f'network/{name}', value, 'us', 'lower')
+        for update_frequency, value in bench_update_policy(repeats=max(3, int(20 * scale))).items():
+            record(f'update_policy/{update_frequency}', value, 'us', 'lower')
+        for env_name, value in bench_env_step(repeats=int(5000 * scale)).items():
+            record(f'env_step/{env_name}', value, 'us', 'lower')
+        for path, value in bench_evaluate().items():
+            record(f'evaluate_100_episodes/{path}', value, 's', 'lower')
+        for name, value in bench_training_throughput().items():
+            record(f'steps_per_second/{name}', value, 'steps/s', 'higher')
+    if solve:
+        for env_name, result in bench_time_to_solve().items():
+            if result['seconds'] is not None:
+                record(f'time_to_solve/{env_name}', result['seconds'], 's', 'lower')
+                record(f'steps_to_solve/{env_name}', result['steps'], 'steps', 'lower')
+            record(f'solved_seeds/{env_name}', result['solved'], 'seeds', 'higher')
+
+    meta = {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'gymnasium': gym.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'quick': quick,
+        'repeats': repeats,
+    }
+    metrics = {name: summarize(values, *kinds[name]) for name, values in samples.items()}
+    return {'meta': meta, 'metrics': metrics}
+
+
+def compare(report, baseline, tolerance=0.25, noise=3.0, max_allowed=0.5):
+    """
+    Returns the list of regressions: metrics worse than the baseline by more than the larger of tolerance
+    and noise times the baseline's spread (relative), capped at max_allowed. Only the baseline's spread
+    counts, so a noisy run does not loosen its own check, and the cap keeps every metric checkable.
+    """
+    regressions = []
+    for name, metric in report['metrics'].items():
+        if name not in baseline['metrics']:
+            continue
+        reference_metric = baseline['metrics'][name]
+        reference, value = reference_metric['value'], metric['value']
+        allowed = min(max(tolerance, noise * reference_metric.get('spread', 0.0)), max_allowed)
+        if metric['better'] == 'lower':
+            worse = value > reference * (1 + allowed)
+        else:
+            worse = value < reference * (1 - allowed)
+        if worse:
+            regressions.append(f"{name}: {value:.4g} {metric['unit']} vs baseline {reference:.4g} {metric['unit']} "
+                               f"(allowed {allowed:.0%})")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="actor-critic performance benchmarks")
+    parser.add_argument('--quick', action='store_true', help="shorter timing loops and 3 repeats by default")
+    parser.add_argument('--repeats', type=int, default=None,
+                        help="runs of the suite to take medians over (default 5, 9 with --save-baseline)")
+    parser.add_argument('--solve', action='store_true', help="also measure time to reach reward_threshold (slow)")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline JSON to check against")
+    parser.add_argument('--save-baseline', action='store_true', help="overwrite the baseline with this run")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument('--noise', type=float, default=3.0, help="allowed slowdown in units of the baseline's spread")
+    parser.add_argument('--max-allowed', type=float, default=0.5, help="cap on the allowed relative slowdown")
+    parser.add_argument('--threads', type=int, default=1, help="torch.set_num_threads for the run")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    repeats = args.repeats if args.repeats is not None else (9 if args.save_baseline else 3 if args.quick else 5)
+    report = run_suite(quick=args.quick, solve=args.solve, repeats=repeats)
+    for name, metric in report['metrics'].items():
+        print(f"{name}: {metric['value']:.4g} {metric['unit']} +/- {metric['spread']:.0%}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.noise, args.max_allowed)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline}")
@@ -0,0 +1,444 @@
+import argparse
+import asyncio
+import copy
+import io
+import json
+import multiprocessing as mp
+import os
+import struct
+from collections import deque
+from time import perf_counter, sleep
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from actorcritic import FrozenColumns, GaussianPolicyNetwork, MultiHeadNetwork, Network, PolicyInference, ProgressiveNetwork
+
+######################################################################
+# 1. Loading and exporting saved policies
+class HalfPrecisionNetwork(nn.Module):
+    """
+    Copy of a policy with float16 weights, half the memory of the float32 one. Takes and returns
+    float32, so it can stand in for the original (e.g. behind PolicyInference).
+    """
+    def __init__(self, network):
+        super(HalfPrecisionNetwork, self).__init__()
+        self.network = copy.deepcopy(network).half()
+        self.is_policy = network.is_policy
+
+    def logits(self, x):
+        return self.network.logits(x.half()).float()
+
+    def forward(self, x):
+        return torch.softmax(self.logits(x), dim=-1) if self.is_policy else self.logits(x)
+
+
+def linear_sizes(state_dict, prefix='network.'):
+    # (in_features, out_features) of the Linear layers of a Sequential, in order
+    weights = sorted((int(key[len(prefix):].split('.')[0]), value) for key, value in state_dict.items()
+                     if key.startswith(prefix) and key.endswith('.weight'))
+    return [(weight.shape[1], weight.shape[0]) for _, weight in weights]
+
+
+def build_policy(state_dict, task=0, metadata=None):
+    """
+    Rebuilds the network a state_dict was saved from: a Network, a ProgressiveNetwork with its frozen
+    columns, a GaussianPolicyNetwork, or task of a MultiHeadNetwork. A network with a single output
+    is taken to be a value network. A Gaussian policy is recognized by its log_std parameter, or by
+    metadata {'policy': 'gaussian', 'action_size', 'state_dependent_std'} (as written next to the weights
+    by ContinuousActorCriticAgent.save_models), which a state-dependent log-std needs.
+    """
+    if any(key.startswith('input_layer.') for key in state_dict):
+        raise ValueError("this is the adapter ProgressiveNetwork of mccacrobot2cartpole.ipynb, which keeps its adapters in "
+                         "a plain list, so their weights are not in the saved state_dict and the model cannot be rebuilt")
+    if 'head_weight' in state_dict:
+        sizes = linear_sizes(state_dict, 'trunk.')
+        num_tasks, output_size, _ = state_dict['head_weight'].shape
+        network = MultiHeadNetwork(sizes[0][0], output_size, num_tasks, [out for _, out in sizes], is_policy=output_size > 1)
+        network.load_state_dict(state_dict)
+        return network.task_network(task)
+
+    sizes = linear_sizes(state_dict)
+    hidden_sizes = [out for _, out in sizes[:-1]]
+    output_size = sizes[-1][1]
+    if 'columns.weight_0' in state_dict:
+        num_columns, state_size, _ = state_dict['columns.weight_0'].shape
+        num_layers = sum(key.startswith('columns.weight_') for key in state_dict)
+        column_sizes = [state_dict[f'columns.weight_{i}'].shape[-1] for i in range(num_layers)]
+        sources = [Network(state_size, 1, column_sizes) for _ in range(num_columns)]
+        columns = FrozenColumns(sources)
+        num_read = (sizes[0][0] - state_size) // columns.hidden_size
+        is_policy = output_size > 1
+        # make_progressive_networks puts the policy sources first and the value sources last
+        column_indices = list(range(num_read)) if is_policy else list(range(num_columns - num_read, num_columns))
+        network = ProgressiveNetwork(state_size, output_size, hidden_sizes, is_policy=is_policy, columns=columns,
+                                     column_indices=column_indices)
+    elif 'log_std' in state_dict:
+        network = GaussianPolicyNetwork(sizes[0][0], output_size, hidden_sizes)
+    elif metadata is not None and metadata.get('policy') == 'gaussian':
+        # with a state-dependent log-std the output layer holds the means and then the log-stds
+        network = GaussianPolicyNetwork(sizes[0][0], metadata['action_size'], hidden_sizes,
+                                        state_dependent_std=metadata.get('state_dependent_std', False))
+    else:
+        network = Network(sizes[0][0], output_size, hidden_sizes, is_policy=output_size > 1)
+    network.load_state_dict(state_dict)
+    return network
+
+
+def export_policy(network, precision='float32'):
+    """
+    The network itself ('float32'), with its Linear layers dynamically quantized to int8 ('int8'),
+    or with float16 weights ('half'). Only categorical policies have reduced-precision variants.
+    """
+    if precision == 'float32':
+        return network
+    if isinstance(network, GaussianPolicyNetwork):
+        raise ValueError("reduced precision is only available for categorical policies")
+    if precision == 'int8':
+        return torch.quantization.quantize_dynamic(copy.deepcopy(network), {nn.Linear}, dtype=torch.qint8)
+    if precision == 'half':
+        return HalfPrecisionNetwork(network)
+    raise ValueError(f"unknown precision {precision}")
+
+
+def load_policy(path, precision='float32', task=0):
+    # <name>.json next to <name>.pth holds metadata for build_policy, if the model was saved with any
+    metadata_path = os.path.splitext(path)[0] + '.json'
+    metadata = None
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+    network = build_policy(torch.load(path, map_location='cpu'), task, metadata)
+    for param in network.parameters():
+        param.requires_grad = False
+    return export_policy(network.eval(), precision)
+
+
+def model_bytes(network):
+    # serialized size of the weights, which also counts packed quantized ones
+    buffer = io.BytesIO()
+    torch.save(network.state_dict(), buffer)
+    return len(buffer.getbuffer())
+
+######################################################################
+# 2. Micro-batching server
+class InferenceServer:
+    """
+    Serves one policy to many clients over a Unix socket (path) or TCP (host, port), with asyncio.
+    Requests that arrive while a batch is being collected are merged, up to max_batch_size or until
+    max_delay seconds after the first one, and answered with a single forward.
+
+    Protocol: on connect the server sends one JSON line with state_size, action_size and
+    kind ('discrete' or 'continuous'). Every request is state_size float32 values, followed for
+    discrete policies by action_size uint8 mask bytes (1 = allowed); every response is the action
+    (int32, or action_size float32) followed by its float32 log-prob. Clients may pipeline requests
+    on a connection; responses come back in order. All values are little-endian.
+    """
+    def __init__(self, policy, max_batch_size=64, max_delay=0.002, deterministic=False, seed=None):
+        self.policy = policy
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.deterministic = deterministic
+        self.continuous = isinstance(policy, GaussianPolicyNetwork)
+        if self.continuous:
+            self.state_size = policy.network[0].in_features
+            self.action_size = policy.action_size
+        else:
+            self.inference = PolicyInference(policy, 'numpy' if PolicyInference.supports_numpy(policy) else 'torch')
+            if seed is not None:
+                self.inference.rng = np.random.default_rng(seed)
+            example = self.inference.logits(np.zeros((1, self.input_size(policy)), dtype=np.float32))
+            self.state_size = self.input_size(policy)
+            self.action_size = example.shape[-1]
+        if seed is not None:
+            torch.manual_seed(seed)
+        self.request_size = 4 * self.state_size + (0 if self.continuous else self.action_size)
+        self.header = (json.dumps({'state_size': self.state_size, 'action_size': self.action_size,
+                                   'kind': 'continuous' if self.continuous else 'discrete'}) + '\n').encode()
+        self.queue = None
+        self.latencies = deque(maxlen=100000)
+        self.batch_sizes = deque(maxlen=100000)
+        self.requests = 0
+        self.first_request = None
+
+    @staticmethod
+    def input_size(policy):
+        for module in policy.modules():
+            if isinstance(module, FrozenColumns):
+                return module.weight_0.shape[1]
+            if hasattr(module, 'in_features'):
+                return module.in_features
+        raise ValueError("cannot tell the input size of the policy")
+
+    def act(self, states, masks):
+        """
+        (actions, log_probs) for a batch of states, as numpy arrays.
+        """
+        if self.continuous:
+            with torch.no_grad():
+                distribution = self.policy.distribution(torch.from_numpy(states))
+                actions = distribution.mean if self.deterministic else distribution.sample()
+                return actions.numpy(), distribution.log_prob(actions).sum(-1).numpy()
+        if not self.deterministic:
+            return self.inference.sample(states, masks)
+        logits = np.where(masks, self.inference.logits(states), -np.inf)
+        actions = logits.argmax(axis=-1)
+        shifted = logits - logits.max(axis=-1, keepdims=True)
+        log_probs = np.take_along_axis(shifted, actions[:, None], axis=-1)[:, 0] - np.log(np.exp(shifted).sum(axis=-1))
+        return actions, log_probs
+
+    def encode(self, action, log_prob):
+        if self.continuous:
+            return np.asarray(action, dtype='<f4').tobytes() + struct.pack('<f', log_prob)
+        return struct.pack('<if', int(action), log_prob)
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        writer.write(self.header)
+
+        async def respond():
+            # answers in request order, as the batches finish
+            while True:
+                future = await pending_items.get()
+                if future is None:
+                    return
+                writer.write(await future)
+                if pending_items.empty():
+                    await writer.drain()
+
+        pending_items = asyncio.Queue()
+        responder = asyncio.ensure_future(respond())
+        try:
+            while True:
+                try:
+                    request = await reader.readexactly(self.request_size)
+                except asyncio.IncompleteReadError:
+                    break
+                future = loop.create_future()
+                await self.queue.put((perf_counter(), request, future))
+                await pending_items.put(future)
+        finally:
+            await pending_items.put(None)
+            await responder
+            writer.close()
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        states = np.zeros((self.max_batch_size, self.state_size), dtype=np.float32)
+        masks = np.ones((self.max_batch_size, self.action_size), dtype=bool)
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+
+            n = len(batch)
+            for i, (_, request, _) in enumerate(batch):
+                states[i] = np.frombuffer(request, dtype='<f4', count=self.state_size)
+                if not self.continuous:
+                    masks[i] = np.frombuffer(request, dtype=np.uint8, offset=4 * self.state_size)
+            actions, log_probs = self.act(states[:n], masks[:n])
+            done = perf_counter()
+            for (arrival, _, future), action, log_prob in zip(batch, actions, log_probs):
+                future.set_result(self.encode(action, float(log_prob)))
+                self.latencies.append(done - arrival)
+            if self.first_request is None:
+                self.first_request = batch[0][0]
+            self.requests += n
+            self.batch_sizes.append(n)
+
+    def stats(self):
+        """
+        Requests served, mean batch size, p50/p99 latency in ms (arrival to answer, over the latest
+        100000 requests) and throughput in requests per second since the first request.
+        """
+        latencies = np.array(self.latencies) * 1e3
+        elapsed = perf_counter() - self.first_request if self.first_request is not None else 0.0
+        return {
+            'requests': self.requests,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+            'throughput': self.requests / elapsed if elapsed > 0 else 0.0,
+        }
+
+    async def serve(self, path=None, host='127.0.0.1', port=7777, report_every=None):
+        """
+        Serves until cancelled, printing stats every report_every seconds.
+        """
+        self.queue = asyncio.Queue()
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        batcher = asyncio.ensure_future(self.batcher())
+        try:
+            async with server:
+                if report_every is None:
+                    await server.serve_forever()
+                while True:
+                    await asyncio.sleep(report_every)
+                    print(json.dumps(self.stats()), flush=True)
+        finally:
+            batcher.cancel()
+
+######################################################################
+# 3. Load generator
+async def open_connection(path=None, host='127.0.0.1', port=7777):
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    header = json.loads(await reader.readline())
+    return reader, writer, header
+
+
+async def client(latencies, stop_time, path, host, port, num_actions, pipeline, seed):
+    """
+    One closed-loop client: keeps pipeline requests with random states in flight until stop_time.
+    """
+    reader, writer, header = await open_connection(path, host, port)
+    rng = np.random.default_rng(seed)
+    state_size, action_size = header['state_size'], header['action_size']
+    response_size = (4 * action_size if header['kind'] == 'continuous' else 4) + 4
+    mask = b'' if header['kind'] == 'continuous' else bytes([1] * min(num_actions or action_size, action_size) +
+                                                             [0] * max(0, action_size - (num_actions or action_size)))
+    sent = deque()
+
+    def send():
+        writer.write(rng.standard_normal(state_size).astype('<f4').tobytes() + mask)
+        sent.append(perf_counter())
+
+    for _ in range(pipeline):
+        send()
+    while sent:
+        await writer.drain()
+        await reader.readexactly(response_size)
+        latencies.append(perf_counter() - sent.popleft())
+        if perf_counter() < stop_time:
+            send()
+    writer.close()
+
+
+async def generate_load(path=None, host='127.0.0.1', port=7777, num_clients=64, duration=5.0, num_actions=None, pipeline=1):
+    """
+    Runs num_clients concurrent clients for duration seconds and returns the request count, the
+    throughput in requests per second and the end-to-end p50/p99 latency in ms.
+    """
+    latencies = []
+    start = perf_counter()
+    await asyncio.gather(*(client(latencies, start + duration, path, host, port, num_actions, pipeline, seed)
+                           for seed in range(num_clients)))
+    seconds = perf_counter() - start
+    latencies = np.array(latencies) * 1e3
+    return {'requests': len(latencies), 'seconds': seconds, 'throughput': len(latencies) / seconds,
+            'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99))}
+
+
+def _serve_process(model_path, precision, path, host, port, max_batch_size, max_delay, deterministic, errors):
+    torch.set_num_threads(1)
+    try:
+        policy = load_policy(model_path, precision)
+        server = InferenceServer(policy, max_batch_size, max_delay, deterministic)
+        asyncio.run(server.serve(path, host, port))
+    except KeyboardInterrupt:
+        pass
+    except Exception as error:
+        # bench re-raises it instead of waiting for a server that never comes up
+        errors.put(error)
+        raise
+
+
+def bench(model_path, precision='float32', path=None, host='127.0.0.1', port=7777, max_batch_size=64, max_delay=0.002,
+          num_clients=64, duration=5.0, num_actions=None, pipeline=1):
+    """
+    Starts a server for model_path in a separate process, drives it with generate_load and
+    returns the load generator's numbers plus the model size in bytes.
+    """
+    ctx = mp.get_context('spawn')
+    errors = ctx.SimpleQueue()
+    process = ctx.Process(target=_serve_process, daemon=True,
+                          args=(model_path, precision, path, host, port, max_batch_size, max_delay, False, errors))
+    process.start()
+    try:
+        # wait until the server accepts connections, or surface the error it died of
+        for _ in range(200):
+            try:
+                asyncio.run(_probe(path, host, port))
+                break
+            except OSError:
+                if not process.is_alive():
+                    process.join()
+                    if not errors.empty():
+                        raise errors.get() from None
+                    raise RuntimeError(f"the server process exited with code {process.exitcode}")
+                sleep(0.05)
+        else:
+            raise TimeoutError("the server did not accept connections within 10 seconds")
+        results = asyncio.run(generate_load(path, host, port, num_clients, duration, num_actions, pipeline))
+    finally:
+        process.terminate()
+        process.join()
+    results['model_bytes'] = model_bytes(load_policy(model_path, precision))
+    return results
+
+
+async def _probe(path, host, port):
+    _, writer, _ = await open_connection(path, host, port)
+    writer.close()
+
+######################################################################
+# 4. Command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-batching inference server for saved policy networks.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name in ('serve', 'load', 'bench'):
+        sub = subparsers.add_parser(name)
+        if name != 'load':
+            sub.add_argument('model', help="a saved *_policy_network.pth")
+            sub.add_argument('--precision', choices=('float32', 'int8', 'half'), default='float32')
+            sub.add_argument('--max-batch-size', type=int, default=64)
+            sub.add_argument('--max-delay-ms', type=float, default=2.0)
+        if name != 'serve':
+            sub.add_argument('--clients', type=int, default=64)
+            sub.add_argument('--duration', type=float, default=5.0)
+            sub.add_argument('--actions', type=int, default=None, help="real actions of the env, the rest are masked")
+            sub.add_argument('--pipeline', type=int, default=1, help="requests in flight per client")
+        sub.add_argument('--unix', default=None, help="Unix socket path (default: TCP)")
+        sub.add_argument('--host', default='127.0.0.1')
+        sub.add_argument('--port', type=int, default=7777)
+    serve_parser = subparsers.choices['serve']
+    serve_parser.add_argument('--deterministic', action='store_true')
+    serve_parser.add_argument('--report-every', type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        policy = load_policy(args.model, args.precision)
+        print(f"Serving {args.model} ({args.precision}, {model_bytes(policy)} bytes) on {args.unix or f'{args.host}:{args.port}'}")
+        server = InferenceServer(policy, args.max_batch_size, args.max_delay_ms / 1e3, args.deterministic)
+        try:
+            asyncio.run(server.serve(args.unix, args.host, args.port, args.report_every))
+        except KeyboardInterrupt:
+            print(json.dumps(server.stats()))
+    elif args.command == 'load':
+        print(json.dumps(asyncio.run(generate_load(args.unix, args.host, args.port, args.clients, args.duration,
+                                                   args.actions, args.pipeline)), indent=2))
+    else:
+        print(json.dumps(bench(args.model, args.precision, args.unix, args.host, args.port, args.max_batch_size,
+                               args.max_delay_ms / 1e3, args.clients, args.duration, args.actions, args.pipeline), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import itertools
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+
+import gymnasium as gym
+import numpy as np
+import torch
+
+from actorcritic import ActorCriticAgent, EnvironmentWrapper
+
+######################################################################
+# 1. Search spaces
+def grid_search_space(base_config, grid, seeds=(0,)):
+    """
+    Every combination of the values in grid (key -> list of values), once per seed.
+    """
+    keys = list(grid)
+    trials = []
+    for values in itertools.product(*(grid[key] for key in keys)):
+        for seed in seeds:
+            trials.append(dict(base_config, **dict(zip(keys, values)), seed=seed))
+    return trials
+
+
+def random_search_space(base_config, space, num_samples, seeds=(0,), sampler_seed=0):
+    """
+    num_samples random draws from space, once per seed. A value in space is either a list
+    to choose from or a callable taking a numpy Generator, e.g. lambda rng: 10 ** rng.uniform(-4, -2).
+    """
+    rng = np.random.default_rng(sampler_seed)
+    trials = []
+    for _ in range(num_samples):
+        params = {}
+        for key, values in space.items():
+            params[key] = values(rng) if callable(values) else values[rng.integers(len(values))]
+        for seed in seeds:
+            trials.append(dict(base_config, **params, seed=seed))
+    return trials
+
+######################################################################
+# 2. Early termination
+class MedianStoppingRule:
+    """
+    Stops a trial whose Average_100 is below the median of the other trials at the same episode.
+    Trials report every check_every episodes through a dict shared by the process pool.
+    """
+    def __init__(self, progress, grace_episodes=200, check_every=50, min_trials=3):
+        self.progress = progress
+        self.grace_episodes = grace_episodes
+        self.check_every = check_every
+        self.min_trials = min_trials
+        self.trial_id = None
+
+    def for_trial(self, trial_id):
+        rule = MedianStoppingRule(self.progress, self.grace_episodes, self.check_every, self.min_trials)
+        rule.trial_id = trial_id
+        return rule
+
+    def __call__(self, episode, results):
+        if episode % self.check_every != 0:
+            return False
+        avg_reward = results['Average_100'][-1]
+        self.progress[(self.trial_id, episode)] = avg_reward
+        if episode < self.grace_episodes:
+            return False
+
+        others = [value for (trial_id, ep), value in self.progress.items() if ep == episode and trial_id != self.trial_id]
+        if len(others) < self.min_trials - 1:
+            return False
+        return avg_reward < np.median(others)
+
+######################################################################
+# 3. Trials
+def _init_worker(num_threads):
+    # one pool worker per core, so torch must not spin up its own thread pool on top
+    torch.set_num_threads(num_threads)
+
+
+def seed_everything(seed, env=None):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if env is not None:
+        env.reset(seed=seed)
+        env.action_space.seed(seed)
+
+
+def run_trial(trial_id, config, make_env_wrapper=None, stopping_rule=None):
+    """
+    Trains one agent on config and returns (trial_id, results). Each trial logs to
+    runs/<experiment>/trial_<trial_id> and is seeded with config['seed'].
+    """
+    config = dict(config, experiment=os.path.join(config['experiment'], f"trial_{trial_id}"))
+    env = gym.make(config['env_name'])
+    seed_everything(config.get('seed', 0), env)
+    env_wrapper = make_env_wrapper(env) if make_env_wrapper is not None else EnvironmentWrapper(env)
+
+    agent = ActorCriticAgent(config)
+    should_stop = stopping_rule.for_trial(trial_id) if stopping_rule is not None else None
+    results = agent.train(env_wrapper, max_episodes=config['max_episodes'], max_steps=config['max_steps'],
+                          reward_threshold=config['reward_threshold'], update_frequency=config['update_frequency'],
+                          should_stop=should_stop)
+    env.close()
+    return trial_id, results
+
+
+def run_sweep(trials, max_workers=None, threads_per_worker=None, make_env_wrapper=None, early_stopping=False,
+              summary_path=None, **stopping_kwargs):
+    """
+    Runs trials (configs from grid_search_space/random_search_space) in a process pool and
+    returns the list of results dicts in trial order. make_env_wrapper must be picklable
+    (a module-level function or class). With summary_path the sweep is also saved with save_summary.
+    """
+    max_workers = max_workers or os.cpu_count()
+    threads_per_worker = threads_per_worker or max(1, os.cpu_count() // max_workers)
+
+    all_results = [None] * len(trials)
+    with Manager() as manager:
+        stopping_rule = MedianStoppingRule(manager.dict(), **stopping_kwargs) if early_stopping else None
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+            futures = [pool.submit(run_trial, trial_id, config, make_env_wrapper, stopping_rule)
+                       for trial_id, config in enumerate(trials)]
+            for future in futures:
+                trial_id, results = future.result()
+                all_results[trial_id] = results
+
+    if summary_path is not None:
+        save_summary(summary_path, trials, all_results)
+    return all_results
+
+######################################################################
+# 4. Columnar summary
+def save_summary(path, trials, all_results):
+    """
+    Saves one column per swept parameter and per scalar result, and [trials, episodes]
+    float32 arrays (NaN padded) for the per-episode curves, into a single .npz file.
+    """
+    columns = {'trial': np.arange(len(trials))}
+    for key in trials[0]:
+        values = [trial[key] for trial in trials]
+        if all(isinstance(value, (int, float, np.number)) for value in values):
+            columns[key] = np.array(values)
+        else:
+            columns[key] = np.array([str(value) for value in values])
+
+    for key in ('Solved', 'Stopped', 'Duration'):
+        columns[key] = np.array([results[key] for results in all_results])
+
+    num_episodes = max(len(results['Reward']) for results in all_results)
+    for key in ('Reward', 'Average_100'):
+        curves = np.full((len(all_results), num_episodes), np.nan, dtype=np.float32)
+        for i, results in enumerate(all_results):
+            curves[i, :len(results[key])] = results[key]
+        columns[key] = curves
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    np.savez(path, **columns)
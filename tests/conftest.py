@@ -0,0 +1,20 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    # train writes its tensorboard runs, checkpoints and models relative to the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def make_config():
+    """
+    Factory for a small CartPole agent config; keyword arguments override or add keys.
+    """
+    def make_config(**overrides):
+        config = dict(device='cpu', state_size=6, action_size=3, hidden_sizes=[16, 16], lr_actor=1e-3, lr_critic=1e-3,
+                      gamma=0.99, verbosity=1000, env_name='CartPole-v1', experiment='test')
+        config.update(overrides)
+        return config
+    return make_config
@@ -0,0 +1,118 @@
+import gymnasium as gym
+import numpy as np
+import pytest
+import torch
+
+from actorcritic import (ActorCriticAgent, EnvironmentWrapper, MultiTaskActorCriticAgent, PaddedEnv, VectorEnvironmentWrapper,
+                         evaluate_policy, fit_action_mask, make_vector_env)
+
+
+class MCCWrapper(EnvironmentWrapper):
+    # the discretizing wrapper of cartpole2mcc.ipynb
+    def __init__(self, env, num_actions=2):
+        super().__init__(env)
+        self.action_space = num_actions
+        self.action_boundaries = np.linspace(-1, 1, num_actions)
+
+    def step(self, action):
+        state, reward, done, truncated, info = self.env.step([self.discretize_action(action)])
+        self.truncated = truncated
+        return self.pad(state), reward, done, info
+
+    def discretize_action(self, action):
+        return self.action_boundaries[max(0, min(action, self.action_space - 1))]
+
+
+def test_fit_action_mask():
+    mask = np.array([True, True, False])
+    assert fit_action_mask(None, 2) is None
+    assert fit_action_mask(mask, 2) is None
+    np.testing.assert_array_equal(fit_action_mask(mask, 3), mask)
+    np.testing.assert_array_equal(fit_action_mask(mask, 4), [True, True, False, False])
+    np.testing.assert_array_equal(fit_action_mask(np.tile([True, False, False], (2, 1)), 2), [[True, False]] * 2)
+
+
+@pytest.mark.parametrize('overrides', [{}, {'fused_network': True}, {'inference_backend': 'torch'},
+                                       {'inference_backend': 'torch', 'inference_compile': 'script'}, {'inference_backend': 'numpy'}],
+                         ids=['default', 'fused', 'torch', 'script', 'numpy'])
+def test_reinitialize_to_narrower_head(overrides, make_config):
+    torch.manual_seed(0)
+    agent = ActorCriticAgent(make_config(**overrides))
+    # acting first builds the inference engine (and its traced graph) at the old width
+    agent.select_action(np.zeros(6, dtype=np.float32))
+    agent.reinitialize_output_layers(2)
+    env_wrapper = MCCWrapper(gym.make('MountainCarContinuous-v0'), num_actions=2)
+
+    state = env_wrapper.reset()
+    mask = agent.env_action_mask(env_wrapper)
+    assert mask is None or mask.shape == (2,)
+    if agent.inference is not None:
+        assert agent.inference.logits(state).shape == (1, 2)
+    actions = [agent.select_action(state, mask)[0] for _ in range(50)]
+    assert set(actions) <= {0, 1}
+
+    agent.train(env_wrapper, max_episodes=2, max_steps=50, reward_threshold=1e9, update_frequency=32)
+
+    returns, lengths = evaluate_policy(agent.policy_network, lambda: MCCWrapper(gym.make('MountainCarContinuous-v0'), num_actions=2),
+                                       n_episodes=2, num_envs=2, max_steps=50, seed=0)
+    assert len(returns) == 2 and (lengths == 50).all()
+    returns, lengths = evaluate_policy(agent.policy_network, lambda: MCCWrapper(gym.make('MountainCarContinuous-v0'), num_actions=2),
+                                       n_episodes=2, num_envs=2, max_steps=50, deterministic=False, seed=0)
+    assert len(returns) == 2
+
+
+def test_wider_head_never_takes_padded_actions(make_config):
+    torch.manual_seed(0)
+    agent = ActorCriticAgent(make_config(inference_backend='numpy'))
+    env_wrapper = MCCWrapper(gym.make('MountainCarContinuous-v0'), num_actions=2)
+    state = env_wrapper.reset()
+    mask = agent.env_action_mask(env_wrapper)
+    np.testing.assert_array_equal(mask, [True, True, False])
+    assert all(agent.select_action(state, mask)[0] != 2 for _ in range(200))
+
+
+def test_multitask_rejects_continuous_env_without_discretizing_wrapper(make_config):
+    agent = MultiTaskActorCriticAgent(make_config(tasks=['CartPole-v1', 'MountainCarContinuous-v0']))
+    env_wrappers = [EnvironmentWrapper(gym.make('CartPole-v1')), EnvironmentWrapper(gym.make('MountainCarContinuous-v0'))]
+    with pytest.raises(ValueError, match='MountainCarContinuous'):
+        agent.train(env_wrappers, max_episodes=1)
+    env_wrappers[1] = MCCWrapper(gym.make('MountainCarContinuous-v0'), num_actions=2)
+    agent.check_env_wrappers(env_wrappers)
+
+
+def test_multitask_reports_solved_episode_per_task(make_config):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    agent = MultiTaskActorCriticAgent(make_config(tasks=['CartPole-v1', 'Acrobot-v1']))
+    env_wrappers = [EnvironmentWrapper(gym.make('CartPole-v1')), EnvironmentWrapper(gym.make('Acrobot-v1'))]
+    # CartPole is solved as soon as there are 100 episodes to average, Acrobot never is
+    results = agent.train(env_wrappers, max_episodes=[120, 3], max_steps=20, reward_thresholds=[0.0, float('inf')],
+                          update_frequency=40)
+    assert results['Solved'] == {'CartPole-v1': 99, 'Acrobot-v1': -1}
+    assert results['Tasks']['CartPole-v1']['Solved'] == 99
+
+
+def test_multitask_rejects_numpy_backend(make_config):
+    with pytest.raises(ValueError, match='numpy'):
+        MultiTaskActorCriticAgent(make_config(tasks=['CartPole-v1'], inference_backend='numpy'))
+
+
+def test_padded_env():
+    env = PaddedEnv(gym.make('CartPole-v1'))
+    observation, info = env.reset(seed=0)
+    assert observation.dtype == np.float32 and observation.shape == (6,)
+    assert env.action_space.n == 3
+    np.testing.assert_array_equal(info['action_mask'], [True, True, False])
+    observation, _, _, _, info = env.step(2)
+    np.testing.assert_array_equal(info['action_mask'], [True, True, False])
+    assert 'action_mask' not in PaddedEnv(gym.make('Acrobot-v1')).reset(seed=0)[1]
+
+
+def test_vector_env_reads_padded_env_masks(make_config):
+    torch.manual_seed(0)
+    vec_env_wrapper = VectorEnvironmentWrapper(make_vector_env('CartPole-v1', 4, max_steps=50))
+    vec_env_wrapper.reset(seed=0)
+    np.testing.assert_array_equal(vec_env_wrapper.action_mask, np.tile([True, True, False], (4, 1)))
+    agent = ActorCriticAgent(make_config())
+    agent.train_vectorized(vec_env_wrapper, max_episodes=8, reward_threshold=1e9, update_frequency=64)
+    vec_env_wrapper.close()
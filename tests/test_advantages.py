@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from actorcritic import gae_advantages, n_step_advantages
+
+GAMMA = 0.9
+
+
+def random_trajectory(steps=30, seed=0):
+    """
+    Rewards, V(s_t), V(s'_t) and terminal/truncation flags of a rollout that crosses a few episodes.
+    s'_t is s_{t+1} inside an episode; after a truncation or the last step it has a value of its own.
+    """
+    rng = np.random.default_rng(seed)
+    rewards, values = rng.standard_normal(steps), rng.standard_normal(steps)
+    dones, truncated = np.zeros(steps), np.zeros(steps)
+    dones[rng.choice([t for t in range(steps - 1) if t != 11], 2, replace=False)] = 1
+    truncated[11] = 1
+    next_values = np.append(values[1:], rng.standard_normal())
+    next_values[11] = rng.standard_normal()
+    return rewards, values, next_values, dones, truncated
+
+
+def deltas_and_ends(rewards, values, next_values, dones, truncated):
+    return rewards + GAMMA * next_values * (1 - dones) - values, np.maximum(dones, truncated)
+
+
+def n_step_reference(rewards, values, next_values, dones, truncated, n):
+    # n-step return minus V(s_t), bootstrapping where the window or the episode (unless terminated) stops
+    ends = np.maximum(dones, truncated)
+    advantages = np.zeros(len(rewards))
+    for t in range(len(rewards)):
+        ret = 0.0
+        for k in range(n):
+            i = t + k
+            ret += GAMMA ** k * rewards[i]
+            if ends[i] or k == n - 1 or i == len(rewards) - 1:
+                ret += GAMMA ** (k + 1) * next_values[i] * (1 - dones[i])
+                break
+        advantages[t] = ret - values[t]
+    return advantages
+
+
+def gae_reference(deltas, ends, lam):
+    advantages = np.zeros(len(deltas))
+    for t in range(len(deltas)):
+        for k in range(len(deltas) - t):
+            advantages[t] += (GAMMA * lam) ** k * deltas[t + k]
+            if ends[t + k]:
+                break
+    return advantages
+
+
+@pytest.mark.parametrize('n', [1, 3, 5, 100])
+def test_n_step_matches_reference(n):
+    trajectory = random_trajectory()
+    deltas, ends = deltas_and_ends(*trajectory)
+    np.testing.assert_allclose(n_step_advantages(deltas, ends, GAMMA, n), n_step_reference(*trajectory, n), atol=1e-10)
+
+
+@pytest.mark.parametrize('lam', [0.0, 0.5, 0.95, 1.0])
+def test_gae_matches_reference(lam):
+    trajectory = random_trajectory()
+    deltas, ends = deltas_and_ends(*trajectory)
+    np.testing.assert_allclose(gae_advantages(deltas, ends, GAMMA, lam), gae_reference(deltas, ends, lam), atol=1e-10)
+    if lam == 1.0:
+        np.testing.assert_allclose(gae_advantages(deltas, ends, GAMMA, lam), n_step_reference(*trajectory, 100), atol=1e-10)
+
+
+def test_batched_envs_match_one_env_at_a_time():
+    trajectories = [deltas_and_ends(*random_trajectory(seed=seed)) for seed in range(4)]
+    deltas = np.stack([d for d, _ in trajectories], axis=1)
+    ends = np.stack([e for _, e in trajectories], axis=1)
+    for env, (env_deltas, env_ends) in enumerate(trajectories):
+        np.testing.assert_allclose(n_step_advantages(deltas, ends, GAMMA, 4)[:, env], n_step_advantages(env_deltas, env_ends, GAMMA, 4))
+        np.testing.assert_allclose(gae_advantages(deltas, ends, GAMMA, 0.9)[:, env], gae_advantages(env_deltas, env_ends, GAMMA, 0.9))
@@ -0,0 +1,27 @@
+from benchmark import compare, summarize
+
+
+def report(value, spread, better='lower'):
+    return {'metrics': {'metric': {'value': value, 'spread': spread, 'unit': 'us', 'better': better}}}
+
+
+def test_summarize():
+    metric = summarize([10.0, 12.0, 11.0, 11.0, 30.0], 'us', 'lower')
+    assert metric['value'] == 11.0 and metric['repeats'] == 5
+    # the outlier does not widen the spread
+    assert abs(metric['spread'] - 1.4826 / 11) < 1e-12
+
+
+def test_compare_allows_for_baseline_noise():
+    assert compare(report(130.0, 0.0), report(100.0, 0.0)) != []
+    assert compare(report(130.0, 0.0), report(100.0, 0.1)) == []
+    assert compare(report(140.0, 0.0), report(100.0, 0.1)) != []
+    # a noisy run does not loosen its own check
+    assert compare(report(140.0, 0.5), report(100.0, 0.1)) != []
+    # baselines without spreads fall back to the plain tolerance
+    assert compare(report(120.0, 0.0), {'metrics': {'metric': {'value': 100.0, 'unit': 'us', 'better': 'lower'}}}) == []
+
+
+def test_compare_caps_the_allowance():
+    assert compare(report(0.0, 0.0, 'higher'), report(100.0, 0.9, 'higher')) != []
+    assert compare(report(160.0, 0.0), report(100.0, 0.9)) != []
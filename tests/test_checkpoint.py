@@ -0,0 +1,28 @@
+import gymnasium as gym
+
+from actorcritic import ActorCriticAgent, EnvironmentWrapper
+
+
+class CountingWrapper(EnvironmentWrapper):
+    state_attributes = ('ticker',)
+
+    def __init__(self, env, num_actions=3):
+        super().__init__(env)
+        self.action_space = num_actions
+        self.ticker = 0
+
+
+def test_rng_state_restores_only_wrapper_state(make_config):
+    agent = ActorCriticAgent(make_config())
+    env_wrapper = CountingWrapper(gym.make('CartPole-v1'))
+    env_wrapper.reset()
+    env_wrapper.ticker = 7
+    rng = agent.rng_state(env_wrapper)
+    assert rng['env_wrapper'] == {'ticker': 7}
+
+    resumed = CountingWrapper(gym.make('CartPole-v1'), num_actions=2)
+    agent.set_rng_state(rng, resumed)
+    assert resumed.ticker == 7 and resumed.action_space == 2
+    # checkpoints that still hold every numeric attribute of the wrapper
+    agent.set_rng_state(dict(rng, env_wrapper={'ticker': 3, 'action_space': 3, 'current': 1}), resumed)
+    assert resumed.ticker == 3 and resumed.action_space == 2 and resumed.current == 0
@@ -0,0 +1,27 @@
+import gymnasium as gym
+import numpy as np
+import torch
+
+from actorcritic import EnvironmentWrapper, GaussianPolicyNetwork, Network, evaluate_policy
+
+
+def test_time_limit_ends_episodes():
+    torch.manual_seed(0)
+    policy = Network(6, 3, [16, 16], is_policy=True)
+    returns, lengths = evaluate_policy(policy, lambda: EnvironmentWrapper(gym.make('Acrobot-v1', max_episode_steps=20)),
+                                       n_episodes=4, num_envs=2, max_steps=500, seed=0)
+    assert len(returns) == 4 and (lengths == 20).all()
+
+
+def test_evaluation_leaves_global_rngs_alone():
+    torch.manual_seed(0)
+    policy, categorical = GaussianPolicyNetwork(6, 1, [16, 16]), Network(6, 3, [16, 16])
+    make_env = lambda: EnvironmentWrapper(gym.make('MountainCarContinuous-v0'))
+    torch_state, numpy_state = torch.get_rng_state(), np.random.get_state()[1].copy()
+    first = evaluate_policy(policy, make_env, n_episodes=2, deterministic=False, num_envs=2, max_steps=50, seed=0)
+    second = evaluate_policy(policy, make_env, n_episodes=2, deterministic=False, num_envs=2, max_steps=50, seed=0)
+    evaluate_policy(categorical, lambda: EnvironmentWrapper(gym.make('CartPole-v1')), n_episodes=2,
+                    deterministic=False, num_envs=2, max_steps=50)
+    np.testing.assert_array_equal(first[0], second[0])
+    assert torch.equal(torch_state, torch.get_rng_state())
+    np.testing.assert_array_equal(numpy_state, np.random.get_state()[1])
@@ -0,0 +1,18 @@
+import numpy as np
+import torch
+
+from actorcritic import Network, PolicyInference
+
+
+def sample_actions(seed, backend):
+    torch.manual_seed(0)
+    np.random.seed(seed)
+    inference = PolicyInference(Network(6, 3, [16, 16]), backend)
+    states = np.random.default_rng(0).standard_normal((64, 6)).astype(np.float32)
+    return inference.sample(states)[0]
+
+
+def test_sampling_follows_the_global_seed():
+    for backend in ('torch', 'numpy'):
+        np.testing.assert_array_equal(sample_actions(0, backend), sample_actions(0, backend))
+        assert (sample_actions(0, backend) != sample_actions(1, backend)).any()
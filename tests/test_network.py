@@ -0,0 +1,53 @@
+import torch
+import torch.optim as optim
+
+from actorcritic import Network, PackedAdam
+
+
+def train_steps(network, optimizer, steps=5, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    for _ in range(steps):
+        states = torch.randn(32, 6, generator=generator)
+        actions = torch.randint(network(states).shape[-1], (32, 1), generator=generator)
+        loss = -torch.log(network(states)).gather(1, actions).sum()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+
+def assert_same_network(network, reference):
+    states = torch.randn(16, 6)
+    torch.testing.assert_close(network(states), reference(states))
+    torch.testing.assert_close(network.log_probs(states), torch.log_softmax(reference.logits(states), dim=-1))
+    for (name, param), (_, reference_param) in zip(network.state_dict().items(), reference.state_dict().items()):
+        torch.testing.assert_close(param, reference_param, msg=name)
+
+
+def test_fused_network_with_packed_adam_matches_adam():
+    torch.manual_seed(0)
+    reference = Network(6, 3, [16, 16])
+    fused = Network(6, 3, [16, 16], fused=True)
+    fused.load_state_dict(reference.state_dict())
+    assert fused.is_packed()
+
+    train_steps(reference, optim.Adam(reference.parameters(), lr=1e-2))
+    train_steps(fused, PackedAdam(fused, lr=1e-2))
+    assert fused.is_packed()
+    assert_same_network(fused, reference)
+
+
+def test_fused_network_matches_after_reinitialize_output_layer():
+    torch.manual_seed(0)
+    reference = Network(6, 3, [16, 16])
+    fused = Network(6, 3, [16, 16], fused=True)
+    fused.load_state_dict(reference.state_dict())
+
+    reference.reinitialize_output_layer(2)
+    fused.reinitialize_output_layer(2)
+    fused.load_state_dict(reference.state_dict())
+    assert [param.requires_grad for param in fused.parameters()] == [param.requires_grad for param in reference.parameters()]
+
+    train_steps(reference, optim.Adam(filter(lambda param: param.requires_grad, reference.parameters()), lr=1e-2), seed=1)
+    train_steps(fused, PackedAdam(fused, lr=1e-2), seed=1)
+    assert fused.is_packed()
+    assert_same_network(fused, reference)
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+import torch
+
+import serve
+from actorcritic import ContinuousActorCriticAgent, GaussianPolicyNetwork, Network
+
+MODELS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+
+
+@pytest.mark.parametrize('state_dependent_std', [False, True])
+def test_load_saved_gaussian_policy(state_dependent_std, make_config):
+    torch.manual_seed(0)
+    agent = ContinuousActorCriticAgent(make_config(action_size=2, env_name='MountainCarContinuous-v0',
+                                                   state_dependent_std=state_dependent_std))
+    agent.save_models('models')
+    rebuilt = serve.load_policy(os.path.join('models', 'MountainCarContinuous-v0_policy_network.pth'))
+    assert isinstance(rebuilt, GaussianPolicyNetwork)
+    assert rebuilt.action_size == 2 and rebuilt.state_dependent_std == state_dependent_std
+    x = torch.randn(4, 6)
+    for expected, actual in zip(agent.policy_network(x), rebuilt(x)):
+        assert torch.allclose(expected, actual)
+
+
+def test_build_policy_categorical():
+    policy = Network(6, 2, [16, 16])
+    assert type(serve.build_policy(policy.state_dict())) is Network
+
+
+def test_bench_reraises_server_error(tmp_path):
+    with pytest.raises(ValueError, match='cannot be rebuilt'):
+        serve.bench(os.path.join(MODELS, 'ProgressiveCartPole_policy_network.pth'), path=str(tmp_path / 'policy.sock'), duration=0.1)
@@ -0,0 +1,55 @@
+import gymnasium as gym
+import numpy as np
+import pytest
+import torch
+
+from actorcritic import ActorCriticAgent, EnvironmentWrapper, TrajectoryDataset, TrajectoryRecorder
+
+
+@pytest.fixture
+def make_agent(make_config):
+    def make_agent(**overrides):
+        return ActorCriticAgent(make_config(record_trajectories='trajectories', record_chunk_size=100,
+                                            checkpoint_dir='checkpoints', **overrides))
+    return make_agent
+
+
+def train(agent, max_episodes, resume=False):
+    env = gym.make('CartPole-v1')
+    env.reset(seed=0)
+    return agent.train(EnvironmentWrapper(env), max_episodes=max_episodes, reward_threshold=1e9, update_frequency=64, resume=resume)
+
+
+def episode_ids(path):
+    dataset = TrajectoryDataset(path)
+    steps = np.concatenate([episode['episodes'] for episode in dataset.episodes()])
+    return dataset.index[:, 0].tolist(), steps
+
+
+def test_second_run_continues_episode_ids(make_agent):
+    torch.manual_seed(0)
+    train(make_agent(), 3)
+    train(make_agent(), 2)
+    ids, steps = episode_ids('trajectories')
+    assert ids == [0, 1, 2, 3, 4]
+    dataset = TrajectoryDataset('trajectories')
+    assert (steps == np.repeat(ids, dataset.index[:, 2])).all()
+
+
+def test_resume_drops_episodes_after_checkpoint(make_agent):
+    torch.manual_seed(0)
+    agent = make_agent(checkpoint_every=2)
+    train(agent, 4)
+    agent.checkpointer.close()
+    # episodes recorded after the last checkpoint, e.g. by a run that crashed
+    recorder = TrajectoryRecorder('trajectories')
+    for _ in range(3):
+        recorder.add(np.zeros(6), 0, 1.0, 0.0)
+    recorder.end_episode(np.zeros(6))
+    recorder.close()
+    assert episode_ids('trajectories')[0] == [0, 1, 2, 3, 4]
+
+    train(make_agent(checkpoint_every=2), 6, resume=True)
+    ids, _ = episode_ids('trajectories')
+    assert ids == [0, 1, 2, 3, 4, 5]
+    assert TrajectoryDataset('trajectories').episode(4)['rewards'].sum() != 3.0
@@ -0,0 +1,31 @@
+import copy
+
+import numpy as np
+import torch
+
+from actorcritic import ActorCriticAgent
+
+
+def random_rollout(agent, steps=40, seed=0):
+    rng = np.random.default_rng(seed)
+    rollout = agent.make_rollout_buffer(steps)
+    for t in range(steps):
+        rollout.add(rng.standard_normal(6), rng.integers(3), rng.standard_normal(), float(t % 13 == 12), 0.0)
+    rollout.finish(rng.standard_normal(6))
+    return rollout
+
+
+def test_batched_update_matches_per_transition_update(make_config):
+    torch.manual_seed(0)
+    batched = ActorCriticAgent(make_config(batched_update=True))
+    serial = ActorCriticAgent(make_config(batched_update=False))
+    serial.policy_network.load_state_dict(batched.policy_network.state_dict())
+    serial.value_network.load_state_dict(batched.value_network.state_dict())
+
+    for seed in range(3):
+        rollout = random_rollout(batched, seed=seed)
+        losses = batched.update_policy(rollout)
+        np.testing.assert_allclose(losses, serial.update_policy(copy.deepcopy(rollout)), rtol=1e-5, atol=1e-5)
+    for network, reference in ((batched.policy_network, serial.policy_network), (batched.value_network, serial.value_network)):
+        for param, reference_param in zip(network.parameters(), reference.parameters()):
+            assert torch.allclose(param, reference_param, atol=1e-6)